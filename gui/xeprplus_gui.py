@@ -3,6 +3,8 @@
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import glob
+from logic.bes3t import read_bes3t
+from logic.dataset_registry import DatasetRegistry
 from matplotlib import rcParams
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
@@ -20,6 +22,9 @@ from types import SimpleNamespace
 from xeprplus_widgets.long_press_button import LongPressButton
 from xeprplus_widgets.radio_treeview import RadioTreeview
 from xeprplus_widgets.vertical_navigation_toolbar_2_tk import VerticalNavigationToolbar2Tk
+
+# Period in ms of the checks for loaded datasets
+LOAD_POLL_MS = 50
     
         
 class XeprPlusMainWindow():
@@ -40,6 +45,7 @@ class XeprPlusMainWindow():
         # self.file_menu.add_command(label="Save")
         self.file_menu.add_command(label="Load dataset")
         self.file_menu.add_command(label="Load folder")
+        self.file_menu.add_command(label="Cancel loading")
 
         # Options menu
         self.options_menu = tk.Menu(self.menubar, tearoff=0)
@@ -496,6 +502,9 @@ class XeprPlusMainWindow():
         self.dset_tree_and_logs_pane.add(
             self.logs_frame, stretch="always"
         )
+        self.load_progressbar = ttk.Progressbar(self.logs_frame,
+                                                mode="determinate")
+        self.load_progressbar.pack(side=tk.BOTTOM, fill=tk.X)
         self.logs_area = tk.Text(self.logs_frame)
         self.logs_area.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
         
@@ -512,6 +521,14 @@ class XeprPlusGui():
         # Threading variables
         self.executor = ThreadPoolExecutor(max_workers=1)  # Create once
         self.meas_fut = None  # Initialize as None
+        # Workers parsing the files of a folder, see
+        # file_menu_load_folder_clicked
+        self.load_executor = ThreadPoolExecutor(
+            max_workers=min(8, os.cpu_count() or 1))
+        self.load_futs = []
+        # Loaded datasets by treeview iid
+        self.dsets = DatasetRegistry()
+        self.dset_tree_items = []
         
         # Change default window behavior of clicking "X" button
         self._mw.win.protocol("WM_DELETE_WINDOW", self._on_closing)
@@ -534,6 +551,10 @@ class XeprPlusGui():
             1,
             command=self.file_menu_load_folder_clicked
             )
+        self._mw.file_menu.entryconfig(
+            2,
+            command=self.file_menu_cancel_loading_clicked
+        )
         self._mw.options_menu.entryconfig(0, command=self.open_xepr_api)
         self._mw.options_menu.entryconfig(1, command=self.close_xepr_api)
 
@@ -563,6 +584,7 @@ class XeprPlusGui():
         
 
     def _on_closing(self):
+        self.load_executor.shutdown(wait=False, cancel_futures=True)
         self._mw.win.destroy()
         self.close_xepr_api()
         
@@ -633,12 +655,10 @@ class XeprPlusGui():
         add_iids = [i for i in new_selected_iids if i not in old_selected_iids]
         for iid in add_iids:
             # The radiobutton is now clicked, add to the canvas
-            idset = self._mw.dset_tree.index(iid)
-            
             # TODO THIS SHOULD GO TO THE LOGIC?
             # The GUI instance should store no variables that are not 
             # or graphical parts
-            dset = self._daw.dsets[idset]
+            dset = self.dsets[iid]
             color = self.datan_get_new_plot_color()
             self._mw.ax.plot(dset.x,
                                       dset.o,
@@ -792,40 +812,81 @@ class XeprPlusGui():
             self._print_log(f"No files with '.DSC' extension in {load_folder}")
 
         # Create a level in the treeview for the folder
-        tree_upper_level = self._mw.datan_dset_tree.add_radio_item(
+        tree_upper_level = self._mw.dset_tree.add_radio_item(
             "",
             tk.END,
             os.path.basename(load_folder)
         )
-        self.datan_dset_tree_items.append(tree_upper_level)
+        self.dset_tree_items.append(tree_upper_level)
+
+        # Import items: the files are parsed by the workers, the datasets are
+        # added to the treeview from the Tk thread in _poll_load_folder
+        self.file_menu_cancel_loading_clicked()
+        paths = [os.path.join(load_folder, f) for f in load_files]
+        self.load_futs = [self.load_executor.submit(read_bes3t, p)
+                          for p in paths]
+        self._mw.load_progressbar.config(maximum=max(len(paths), 1), value=0)
+        self._print_log(f"Loading {len(paths)} datasets from {load_folder}")
+        self._mw.win.after(LOAD_POLL_MS, self._poll_load_folder,
+                           self.load_futs, paths, tree_upper_level, 0)
+
+
+    def _poll_load_folder(self, futs, paths, folder, ifut):
+        if futs is not self.load_futs:
+            # Cancelled or replaced by another folder
+            return
+        # Add the datasets that are ready, in the order of the files. Stop
+        # after LOAD_POLL_MS to keep the window responsive.
+        start_time = time.time()
+        while ifut < len(futs) and futs[ifut].done():
+            try:
+                self.add_dataset(futs[ifut].result(), folder)
+            except Exception as e:
+                self._print_log(f"Could not load {paths[ifut]}: {e}")
+            ifut += 1
+            if time.time() - start_time > LOAD_POLL_MS*1e-3:
+                break
+        self._mw.load_progressbar.config(value=ifut)
+
+        if ifut < len(futs):
+            self._mw.win.after(LOAD_POLL_MS, self._poll_load_folder,
+                               futs, paths, folder, ifut)
+        else:
+            self.load_futs = []
+            self._print_log(f"Loaded {len(futs)} datasets")
+
+
+    def file_menu_cancel_loading_clicked(self):
+        if not self.load_futs:
+            return
+        for fut in self.load_futs:
+            fut.cancel()
+        self._print_log(
+            f"Loading cancelled after "
+            f"{int(self._mw.load_progressbar['value'])} of "
+            f"{len(self.load_futs)} datasets")
+        self.load_futs = []
+
 
-        # Import items
-        for f in load_files:
-            self.load_single_dataset(
-                os.path.join(load_folder, f),
-                tree_upper_level
-            )
-        
-        
     def load_single_dataset(self, path_to_file, folder=""):
-        # Load from memory to Xepr secondary viewport
-        self._logic.load_data(path_to_file, 'secondary')
-        # Load from Xepr to window
-        dset = self._logic.get_dataset(xeprset="secondary")
-        # Store in meas_dsets
-        params = {"title": dset.getTitle(),
-                  "mw_freq": dset.getSPLReal("MWFQ"),
-                  "mw_": dset.getSPLReal("MWPW")}
-        ds = SimpleNamespace(x=dset.X, o=dset.O, params=params)
-        self.meas_dsets = np.append(self.meas_dsets, ds)
+        # Read the BES3T files directly, Xepr is not needed
+        self.add_dataset(read_bes3t(path_to_file), folder)
+
+
+    def add_dataset(self, dset, folder=""):
+        # Store the dict returned by read_bes3t in dsets
+        params = {"title": dset["title"],
+                  "mw_freq": dset["params"].get("MWFQ"),
+                  "mw_": dset["params"].get("MWPW")}
+        ds = SimpleNamespace(x=dset["x"], o=dset["o"], params=params)
         # Append to treeview
-        self.datan_dset_tree_items.append(
-            self._mw.datan_dset_tree.add_radio_item(
-                folder,
-                tk.END,
-                params['title']
-            )
+        iid = self._mw.dset_tree.add_radio_item(
+            folder,
+            tk.END,
+            params['title']
         )
+        self.dset_tree_items.append(iid)
+        self.dsets.add(iid, ds, folder)
 
 
     def datan_dset_tree_clicked(self, event):
@@ -840,8 +901,7 @@ class XeprPlusGui():
         add_iids = [i for i in new_selected_iids if i not in old_selected_iids]
         for iid in add_iids:
             # The radiobutton is now clicked, add to the canvas
-            idset = self._mw.datan_dset_tree.index(iid)
-            dset = self._daw.dsets[idset]
+            dset = self.dsets[iid]
             color = self.datan_get_new_plot_color()
             self._daw.cur_tab.ax.plot(dset.x,
                                       dset.o,
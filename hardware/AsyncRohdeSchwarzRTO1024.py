@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# asyncio interface to the RohdeSchwarzRTO1024 oscilloscope. VISA calls are
+# blocking, so each call of the wrapped driver runs in a thread of the
+# instrument: one worker, so that the VISA session is never used by two
+# threads at once. Waiting for an acquisition does not
+# block any thread: the event status register is polled with asyncio.sleep
+# in between, so one event loop can coordinate several instruments.
+#
+#   scope = await AsyncRohdeSchwarzRTO1024.open('TCPIP::...')
+#   await scope.run('set_timebase_scale', 1e-6, 0)
+#   wfm = await scope.acquire([1, 2])
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import time
+
+from hardware.RohdeSchwarzRTO1024 import RohdeSchwarzRTO1024
+
+
+class AsyncRohdeSchwarzRTO1024:
+    def __init__(self, scope, executor=None):
+        """
+        Use AsyncRohdeSchwarzRTO1024.open() to connect from a coroutine.
+        @param scope: RohdeSchwarzRTO1024 with completion='opc_query'
+        @param executor: Single thread executor for the VISA calls, None to
+            create one
+        """
+        if scope._completion != 'opc_query':
+            raise ValueError(
+                "The asyncio driver needs completion='opc_query'.")
+        self.scope = scope
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1,
+                                          thread_name_prefix='visa_io')
+        self._executor = executor
+        # One call at a time on the VISA session
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, address, **kwargs):
+        # kwargs are passed to RohdeSchwarzRTO1024
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1,
+                                      thread_name_prefix='visa_io')
+        scope = await loop.run_in_executor(
+            executor, partial(RohdeSchwarzRTO1024, address, **kwargs))
+        return cls(scope, executor)
+
+    async def _call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            future = loop.run_in_executor(
+                self._executor, partial(function, *args, **kwargs))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The worker thread still uses the session: keep the lock
+                # until the call has returned
+                while not future.done():
+                    try:
+                        await asyncio.wait([future])
+                    except asyncio.CancelledError:
+                        continue
+                raise
+
+    async def run(self, method, *args, **kwargs):
+        """
+        Calls a method of the wrapped driver without blocking the loop, e.g.
+        await scope.run('set_yaxis', 0.1, 0, 0.1, 0)
+        """
+        return await self._call(getattr(self.scope, method), *args, **kwargs)
+
+    async def query(self, message):
+        return await self._call(self.scope._connection.query, message)
+
+    async def write(self, message):
+        await self._call(self.scope._connection.write, message)
+        return
+
+    async def arm(self):
+        await self.run('arm')
+        return
+
+    async def wait_acquisition(self, timeout=None, poll_interval=0.005):
+        """
+        Waits for the end of the acquisition started with arm(). If the
+        waiting coroutine is cancelled, the acquisition is stopped.
+        @param timeout: Maximum waiting time in s, None to wait forever
+        @param poll_interval: Time between two checks in s
+        @return: True if the acquisition is finished, False on timeout
+        """
+        start_time = time()
+        try:
+            while True:
+                esr = await self.query('*ESR?')
+                if int(esr) & 1:
+                    return True
+                if timeout is not None and time() - start_time > timeout:
+                    return False
+                await asyncio.sleep(poll_interval)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.write('STOP'))
+            raise
+
+    async def acquire(self, channels, data_format='REAL,32', timeout=None):
+        # Arm, wait and return the Waveform of channels (see get_channels)
+        await self.arm()
+        if not await self.wait_acquisition(timeout):
+            await self.write('STOP')
+            raise TimeoutError("Acquisition not finished in time.")
+        return await self.run('get_channels', channels, data_format)
+
+    async def get_waveform(self, channel, data_format='REAL,32'):
+        return await self.run('get_waveform', channel, data_format)
+
+    async def get_channels(self, channels, data_format='REAL,32'):
+        return await self.run('get_channels', channels, data_format)
+
+    async def disconnect(self):
+        await self.run('disconnect')
+        self._executor.shutdown(wait=False)
+        return
@@ -2,93 +2,709 @@
 # Written by Gianluca Marcozzi g.marcozzi@fu-berlin.de
 # 2024-12-05
 
+from contextlib import contextmanager
+import json
 import numpy as np
+import os
 import pyvisa as visa
-from time import sleep
+import queue
+import threading
+from time import sleep, time
+
+from hardware.VisaSession import VisaSession
+
+# Waveform transfer formats: pyvisa datatype and number of bits per value
+DATA_FORMATS = {
+    'REAL,32': ('f', 32),
+    'INT,8': ('b', 8),
+    'INT,16': ('h', 16),
+    'ASCii': (None, None),
+}
+
+# Folder on the instrument where the exported files are written
+REMOTE_FOLDER = "C:\\Users\\Public\\files\\gianluca\\"
+
+# Files written by a binary waveform export: XML header and data
+BINARY_EXPORT_SUFFIXES = ('.bin', '.Wfm.bin')
+
+# Settings that the instrument may change when the key setting is written
+COUPLED_SETTINGS = {
+    'TIM:SCAL': ('ACQ:RES', 'ACQ:POIN'),
+    'ACQ:RES': ('TIM:SCAL', 'ACQ:POIN'),
+}
+
+def join_commands(commands):
+    # One SCPI message. After a ';' a header is resolved relative to the
+    # subsystem of the previous command, so all but the first get the root
+    # prefix ':'. Common commands (*OPC, ...) are not part of the tree.
+    return ';'.join(command if i == 0 or command.startswith((':', '*'))
+                    else ':' + command
+                    for i, command in enumerate(commands))
+
+
+class Waveform:
+    """
+    Record read from the oscilloscope. The y values are kept as np.ndarray and
+    the x axis is only built from start, stop and npoints when accessed.
+    """
+    __slots__ = ('y', 'start', 'stop', 'npoints', '_x')
+
+    def __init__(self, y, start, stop, npoints):
+        self.y = y
+        self.start = start
+        self.stop = stop
+        self.npoints = npoints
+        self._x = None
+
+    @property
+    def x(self):
+        if self._x is None:
+            self._x = np.linspace(self.start, self.stop, self.npoints)
+        return self._x
+
+    @property
+    def dx(self):
+        return (self.stop - self.start) / (self.npoints - 1)
+
+    def __len__(self):
+        return self.npoints
+
+
+class CommandStatistics:
+    """
+    Per SCPI message counts, byte volumes and latency histograms, filled by
+    InstrumentedConnection. Messages are grouped by their headers, without
+    the values, e.g. 'CHAN1:SCAL;CHAN1:OFFS;*OPC?'.
+    """
+    # Edges of the latency histogram in s, 4 bins per decade
+    BIN_EDGES = 10.**np.arange(-5, 2.25, 0.25)
+
+    def __init__(self):
+        self.commands = {}
+
+    @staticmethod
+    def command_key(message):
+        return ';'.join(command.strip().split(' ')[0]
+                        for command in message.split(';'))
+
+    def record(self, message, latency, nbytes_sent, nbytes_received):
+        key = self.command_key(message)
+        if key not in self.commands:
+            self.commands[key] = {
+                'count': 0,
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                'total_time': 0.,
+                'min_time': np.inf,
+                'max_time': 0.,
+                'histogram': [0] * (len(self.BIN_EDGES) + 1),
+            }
+        stats = self.commands[key]
+        stats['count'] += 1
+        stats['bytes_sent'] += nbytes_sent
+        stats['bytes_received'] += nbytes_received
+        stats['total_time'] += latency
+        stats['min_time'] = min(stats['min_time'], latency)
+        stats['max_time'] = max(stats['max_time'], latency)
+        stats['histogram'][int(np.searchsorted(self.BIN_EDGES, latency))] += 1
+        return
+
+    def reset(self):
+        self.commands = {}
+        return
+
+    def summary(self):
+        # Table sorted by total time spent in each command
+        rows = sorted(self.commands.items(),
+                      key=lambda item: item[1]['total_time'], reverse=True)
+        lines = ['{:<40s} {:>7s} {:>10s} {:>9s} {:>9s} {:>9s} {:>12s}'.format(
+            'command', 'count', 'total s', 'mean ms', 'min ms', 'max ms',
+            'bytes in')]
+        for key, stats in rows:
+            lines.append(
+                '{:<40s} {:>7d} {:>10.3f} {:>9.3f} {:>9.3f} {:>9.3f} '
+                '{:>12d}'.format(
+                    key[:40], stats['count'], stats['total_time'],
+                    stats['total_time'] / stats['count'] * 1e3,
+                    stats['min_time'] * 1e3, stats['max_time'] * 1e3,
+                    stats['bytes_received']))
+        return '\n'.join(lines)
+
+    def to_json(self, path=None):
+        # Return the statistics as JSON string, also written to path if given
+        dump = json.dumps({
+            'histogram_bin_edges_s': self.BIN_EDGES.tolist(),
+            'commands': self.commands,
+        }, indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(dump)
+        return dump
+
+
+class InstrumentedConnection:
+    """
+    Wraps a pyvisa resource and records every message in a CommandStatistics.
+    Attributes that are not wrapped are forwarded to the resource.
+    """
+    def __init__(self, connection, statistics):
+        self._connection = connection
+        self.statistics = statistics
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        if name in ('_connection', 'statistics'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._connection, name, value)
+
+    def write(self, message):
+        start_time = time()
+        result = self._connection.write(message)
+        self.statistics.record(message, time() - start_time, len(message), 0)
+        return result
+
+    def query(self, message):
+        start_time = time()
+        response = self._connection.query(message)
+        self.statistics.record(message, time() - start_time, len(message),
+                               len(response))
+        return response
+
+    def query_binary_values(self, message, **kwargs):
+        start_time = time()
+        values = self._connection.query_binary_values(message, **kwargs)
+        nbytes = values.nbytes if hasattr(values, 'nbytes') else \
+            len(values) * np.dtype(kwargs.get('datatype', 'f')).itemsize
+        self.statistics.record(message, time() - start_time, len(message),
+                               nbytes)
+        return values
+
+    def wait_on_event(self, event_type, timeout):
+        start_time = time()
+        result = self._connection.wait_on_event(event_type, timeout)
+        self.statistics.record('(wait service request)', time() - start_time,
+                               0, 0)
+        return result
+
 
 class RohdeSchwarzRTO1024:
-    def __init__(self, address):
+    def __init__(self, address, completion='opc_query', connection=None,
+                 reset=True):
+        # completion: 'opc_query' to wait with a blocking *OPC? query,
+        # 'srq' to wait for the service request raised by *OPC
+        # connection: already opened resource to use instead of opening
+        # address, e.g. a RohdeSchwarzRTO1024Sim
+        # reset: send *RST, set to False to keep the instrument settings
+        if completion not in ('opc_query', 'srq'):
+            raise ValueError("completion must be 'opc_query' or 'srq'")
         self._address = address
-        self.rm = visa.ResourceManager()
-        # print(self.rm.list_resources())
-        try:
-            self._connection = self.rm.open_resource(self._address)
-        except:
-            print('Error connecting RohdeSchwarzRTO1024\n')
+        self._completion = completion
+        # List of queued commands while inside a batch() block, else None
+        self._batch = None
+        # Acquisition pipeline, see start_pipeline()
+        self._pipeline_thread = None
+        self._pipeline_queue = None
+        self._pipeline_stop = threading.Event()
+        self._pipeline_error = None
+        # Shadow copy of the instrument settings: values written with _set
+        # and values read back with _get, keyed by SCPI header
+        if connection is not None:
+            self._session = None
+            self._connection = connection
+            self._written = {}
+            self._readback = {}
+        else:
+            # Shared with the other drivers opened on the same address. So
+            # is the shadow copy, which sees the writes and resets of all
+            # the drivers.
+            self._session = VisaSession.open(self._address)
+            self._connection = self._session
+            self._written = self._session.written
+            self._readback = self._session.readback
             
         self.model = self._connection.query('*IDN?').split(',')[1]
         print('Connected to oscilloscope: {}.'.format(self.model))
+        if self._completion == 'srq':
+            # Before the first _command_wait, which waits for the request
+            self._enable_srq()
         self._command_wait('*CLS')
-        self._command_wait('*RST')
+        if reset:
+            self.reset()
         return
     
+    def enable_instrumentation(self):
+        # Record count, bytes and latency of every SCPI message. Return the
+        # CommandStatistics, also available as self.statistics.
+        if not isinstance(self._connection, InstrumentedConnection):
+            self._connection = InstrumentedConnection(
+                self._connection, CommandStatistics())
+        return self.statistics
+
+    def disable_instrumentation(self):
+        if isinstance(self._connection, InstrumentedConnection):
+            self._connection = self._connection._connection
+        return
+
+    @property
+    def statistics(self):
+        if isinstance(self._connection, InstrumentedConnection):
+            return self._connection.statistics
+        return None
+
+    def reset(self):
+        # Reset the instrument and forget the cached settings
+        self._command_wait('*RST')
+        self.invalidate_cache()
+        return
+
+    def invalidate_cache(self, header=None):
+        # Forget the cached value of header, or of all settings if None
+        if header is None:
+            self._written.clear()
+            self._readback.clear()
+        else:
+            self._written.pop(header, None)
+            self._readback.pop(header, None)
+        return
+
     def disconnect(self):
-        self.rm.close()
+        self.stop_pipeline()
+        if self._session is None:
+            self._connection.close()
+        else:
+            self._session.release()
         return
+
+    def is_connected(self):
+        # Health check: the instrument answers *IDN?
+        try:
+            self._connection.query('*IDN?')
+            return True
+        except Exception:
+            return False
         
     def _command_wait(self, command_str):
         """
         Writes the command in command_str via ressource manager and waits until
-        the device has finished processing it.
+        the device has finished processing it. Inside a batch() block the
+        command is only queued.
         @param command_str: The command to be written
         """
-        self._connection.write(command_str)
-        self._connection.write('*WAI')
-        while int(float(self._connection.query('*OPC?'))) != 1:
-            sleep(0.02)
+        if self._batch is not None:
+            self._batch.append(command_str)
+            return
+        self._send_wait(command_str)
+        return
+
+    def _enable_srq(self):
+        # Operation complete (ESR bit 0) sets the event status bit of the
+        # status byte, which raises a service request. The enable registers
+        # are kept by *CLS and *RST.
+        self._connection.write('*ESE 1;*SRE 32')
+        self._connection.enable_event(
+            visa.constants.EventType.service_request,
+            visa.constants.EventMechanism.queue)
+        return
+
+    def _send_wait(self, message):
+        """
+        Sends one SCPI message (possibly several commands joined with
+        join_commands) and performs a single completion check.
+        @param message: The message to be written
+        """
+        if self._completion == 'srq':
+            self._connection.write(message + ';*OPC')
+            self._connection.wait_on_event(
+                visa.constants.EventType.service_request,
+                self._connection.timeout)
+            # Reading the event status register clears it for the next *OPC
+            self._connection.query('*ESR?')
+        else:
+            # *OPC? only answers when all the previous commands are done
+            self._connection.query(message + ';*OPC?')
+        return
+
+    @contextmanager
+    def batch(self):
+        """
+        Queues the commands sent inside the with block and sends them as one
+        message (see join_commands) with a single completion check at the
+        end.
+        Nested batches are sent together with the outermost one.
+        """
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        except Exception:
+            # The queued settings were never sent
+            self._batch = None
+            self.invalidate_cache()
+            raise
+        commands, self._batch = self._batch, None
+        if commands:
+            try:
+                self._send_wait(join_commands(commands))
+            except Exception:
+                # Unknown which of the settings the instrument received
+                self.invalidate_cache()
+                raise
         return
     
-    def get_xy_values(self, channel, format_type=list):
-        # Return x and y data that are passed in ASCii
-        # Set data format
-        self._command_wait('FORM:DATA ASCii')
-        
-        # Do not include the x-values in the data. They will be constructed
-        # from the header
-        self._command_wait('EXP:WAV:INCX OFF')
-        
-        # Get y as string and transform to list of strings
-        yraw = self._connection.query('CHAN%u:DATA:VALUES?' % channel)
-        y = yraw.split('\n')[0]
-        y = y.split(',')
-        y = [float(elem) for elem in y]
-        
-        # Get header and build the x axis list
+    def _set(self, header, value):
+        """
+        Writes a setting unless the same value was already written.
+        @param header: The SCPI header, e.g. 'TIM:SCAL'
+        @param value: The value to be written
+        """
+        value = str(value)
+        if self._written.get(header) == value:
+            return
+        try:
+            self._command_wait('{} {}'.format(header, value))
+        except Exception:
+            # The instrument may or may not have the new value
+            self.invalidate_cache(header)
+            raise
+        self._written[header] = value
+        self._readback.pop(header, None)
+        for coupled in COUPLED_SETTINGS.get(header, ()):
+            self.invalidate_cache(coupled)
+        return
+
+    def _get(self, header):
+        """
+        Returns the value of a setting as reported by the instrument. The
+        instrument is only queried if the value is not cached.
+        @param header: The SCPI header, e.g. 'TIM:SCAL'
+        """
+        if header not in self._readback:
+            self._readback[header] = self._connection.query(header + '?')
+        return self._readback[header]
+
+    def _int_to_volts(self, channel, raw, nbits):
+        """
+        Converts the ADC values of an INT,8 or INT,16 transfer into volts.
+        @param channel: The channel the values were read from
+        @param raw: The integer values as np.ndarray
+        @param nbits: 8 or 16
+        """
+        # Full vertical range (10 divisions) corresponds to 253 ADC levels
+        # for 8 bit data and to 253 * 256 levels for 16 bit data
+        scale = float(self._get('CHAN%u:SCAL' % channel))
+        offset = float(self._get('CHAN%u:OFFS' % channel))
+        position = float(self._get('CHAN%u:POS' % channel))
+        lsb = 10 * scale / (253 * 2**(nbits - 8))
+        return raw * lsb - position * scale + offset
+
+    def get_waveform(self, channel, data_format='REAL,32'):
+        # Return a Waveform. The y values are transferred as binary block
+        # (data_format 'REAL,32', 'INT,8' or 'INT,16') and decoded directly
+        # into a np.ndarray. data_format 'ASCii' is kept as fallback.
+        self._setup_transfer(data_format)
+        y = self._read_values('CHAN%u:DATA:VALUES?' % channel, channel,
+                              data_format)
+        start, stop, npoints = self._read_header(channel)
+        return Waveform(y, start, stop, npoints)
+
+    def get_channels(self, channels, data_format='REAL,32'):
+        # Return a Waveform whose y is a 2D array with one row per channel.
+        # The channels share the time axis, so format and header are only
+        # set and read once.
+        self._setup_transfer(data_format)
+        y = np.stack([self._read_values('CHAN%u:DATA:VALUES?' % ch, ch,
+                                        data_format) for ch in channels])
+        start, stop, npoints = self._read_header(channels[0])
+        return Waveform(y, start, stop, npoints)
+
+    def _setup_transfer(self, data_format, window=None):
+        # window: (start, stop) time range to transfer, None for all
+        if data_format not in DATA_FORMATS:
+            raise ValueError("data_format must be one of {}".format(
+                list(DATA_FORMATS.keys())))
+
+        with self.batch():
+            # Set data format
+            self._set('FORM:DATA', data_format)
+            if data_format != 'ASCii':
+                # Binary values are sent little endian
+                self._set('FORM:BORD', 'LSBFirst')
+
+            # Do not include the x-values in the data. They will be
+            # constructed from the header
+            self._set('EXP:WAV:INCX', 'OFF')
+
+            if window is None:
+                self._set('EXP:WAV:SCOP', 'WFM')
+            else:
+                self._set('EXP:WAV:SCOP', 'MAN')
+                self._set('EXP:WAV:STAR', window[0])
+                self._set('EXP:WAV:STOP', window[1])
+        return
+
+    def _read_values(self, query, channel, data_format):
+        if data_format == 'ASCii':
+            # Get y as string and transform to array of floats
+            yraw = self._connection.query(query)
+            return np.array(yraw.split('\n')[0].split(','), dtype=float)
+
+        # Get y as IEEE 488.2 definite length block
+        datatype, nbits = DATA_FORMATS[data_format]
+        y = self._connection.query_binary_values(
+            query, datatype=datatype, is_big_endian=False, container=np.array)
+        if nbits != 32:
+            y = self._int_to_volts(channel, y, nbits)
+        return y
+
+    def _read_header(self, channel):
+        # Header: start time, stop time, number of samples, values per sample
         head = self._connection.query('CHAN%u:DATA:HEADER?' % channel)
         head = head.split(',')
-        head = [float(elem) for elem in head]
-        x = [elem for elem in np.linspace(head[0], head[1], int(head[2]))]
-        
+        return float(head[0]), float(head[1]), int(float(head[2]))
+
+    def get_preview(self, channel, npoints=2000, window=None):
+        # Return a Waveform for live display, whose y is a 2D array with the
+        # min (row 0) and max (row 1) of the record in npoints time bins.
+        # The record is transferred as INT,8, optionally restricted to the
+        # window (start, stop) time range. Use get_waveform for full
+        # resolution data.
+        self._setup_transfer('INT,8', window)
+        y = self._read_values('CHAN%u:DATA:VALUES?' % channel, channel,
+                              'INT,8')
+        start, stop, nsamples = self._read_header(channel)
+        if window is not None and nsamples > 1:
+            # The header describes the whole record: the transferred samples
+            # start at the first sample time inside the window
+            dt = (stop - start) / (nsamples - 1)
+            first = max(int(np.ceil((window[0] - start) / dt - 1e-6)), 0)
+            start = start + first * dt
+            stop = start + (len(y) - 1) * dt
+        nsamples = len(y)
+        if nsamples <= npoints:
+            return Waveform(np.stack([y, y]), start, stop, nsamples)
+
+        # Bin edges, the bins differ at most by one sample in length
+        edges = np.linspace(0, nsamples, npoints + 1).astype(int)[:-1]
+        envelope = np.stack([np.minimum.reduceat(y, edges),
+                             np.maximum.reduceat(y, edges)])
+        # Time of the bin centers
+        dt = (stop - start) / (nsamples - 1)
+        bin_width = nsamples / npoints * dt
+        return Waveform(envelope, start + bin_width / 2,
+                        stop - bin_width / 2, npoints)
+
+    def get_segments(self, channel, nsegments, data_format='REAL,32'):
+        # Return a Waveform whose y is a 2D array (nsegments, npoints) with
+        # the last nsegments acquisitions of the history memory. With data
+        # logging the history is played back and read in one transfer.
+        self._setup_transfer(data_format)
+        try:
+            with self.batch():
+                self._set('CHAN%u:HIST:STAT' % channel, 'ON')
+                self._set('CHAN%u:HIST:STAR' % channel, -(nsegments - 1))
+                self._set('CHAN%u:HIST:STOP' % channel, 0)
+                self._set('CHAN%u:HIST:REPL' % channel, 'OFF')
+                self._set('EXP:WAV:DLOG', 'ON')
+                self._command_wait('CHAN%u:HIST:PLAY' % channel)
+            y = self._read_values('CHAN%u:DATA:VALUES?' % channel, channel,
+                                  data_format)
+            start, stop, npoints = self._read_header(channel)
+        finally:
+            # Back to the readout of the current acquisition
+            with self.batch():
+                self._set('EXP:WAV:DLOG', 'OFF')
+                self._set('CHAN%u:HIST:STAT' % channel, 'OFF')
+        if y.size != nsegments * npoints:
+            raise ValueError(
+                "The history holds %u acquisitions of %u points, %u were "
+                "requested." % (y.size // npoints, npoints, nsegments))
+        return Waveform(y.reshape(nsegments, npoints), start, stop, npoints)
+
+    def get_xy_values(self, channel, format_type=list, data_format='REAL,32'):
+        # Return x and y data, as np.ndarray if format_type is 'nparray'
+        # (no copy of y) or as lists otherwise. Prefer get_waveform, which
+        # does not build the x axis.
+        wfm = self.get_waveform(channel, data_format)
         if format_type == 'nparray':
-            x = np.array(x)
-            y = np.array(y)
-        
-        return x, y 
+            return wfm.x, wfm.y
+        return wfm.x.tolist(), wfm.y.tolist()
         
+    def arm(self):
+        # Start a single acquisition without waiting for it. Its end sets
+        # the operation complete bit of the event status register.
+        self._connection.write('RUNSingle;*OPC')
+        return
+
+    def wait_acquisition(self, timeout=None):
+        """
+        Waits for the end of the acquisition started with arm().
+        @param timeout: Maximum waiting time in s, None to wait forever
+        @return: True if the acquisition is finished, False on timeout
+        """
+        if self._completion == 'srq':
+            timeout_ms = None if timeout is None else int(timeout * 1000)
+            try:
+                self._connection.wait_on_event(
+                    visa.constants.EventType.service_request, timeout_ms)
+            except visa.errors.VisaIOError:
+                return False
+            self._connection.query('*ESR?')
+            return True
+
+        start_time = time()
+        while not int(self._connection.query('*ESR?')) & 1:
+            if timeout is not None and time() - start_time > timeout:
+                return False
+            sleep(0.005)
+        return True
+
+    def start_pipeline(self, channels, data_format='REAL,32', maxsize=8,
+                       overlap=True):
+        """
+        Starts a background thread that acquires single records of channels
+        and puts them in a bounded queue, read with get_record(). With
+        overlap, the next acquisition is armed as soon as the previous one
+        is finished and the previous record is transferred while the scope
+        waits for the next trigger. This requires the transfer to be shorter
+        than the trigger period, use overlap=False otherwise.
+        While the pipeline runs, the thread is the only user of the scope.
+        @param channels: List of channels to read, e.g. [1, 2]
+        @param data_format: Transfer format, see get_waveform()
+        @param maxsize: Maximum number of records waiting in the queue
+        @param overlap: Re-arm before transferring the previous record
+        """
+        if self._pipeline_thread is not None:
+            raise RuntimeError("Acquisition pipeline already running.")
+        # Configure the transfer now: no setting is written while armed
+        self._setup_transfer(data_format)
+        self._pipeline_queue = queue.Queue(maxsize=maxsize)
+        self._pipeline_stop.clear()
+        self._pipeline_error = None
+        self._pipeline_thread = threading.Thread(
+            target=self._pipeline_loop,
+            args=(list(channels), data_format, overlap),
+            daemon=True)
+        self._pipeline_thread.start()
+        return
+
+    def _pipeline_loop(self, channels, data_format, overlap):
+        try:
+            self.arm()
+            while not self._pipeline_stop.is_set():
+                # Short timeout to check regularly for stop requests
+                if not self.wait_acquisition(timeout=0.5):
+                    continue
+                timestamp = time()
+                if overlap:
+                    self.arm()
+                wfm = self.get_channels(channels, data_format)
+                if not overlap:
+                    self.arm()
+                while not self._pipeline_stop.is_set():
+                    try:
+                        self._pipeline_queue.put((timestamp, wfm),
+                                                 timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self._pipeline_error = e
+        finally:
+            # Leave the scope stopped
+            self._connection.write('STOP')
+        return
+
+    def get_record(self, timeout=None):
+        """
+        Returns the next (timestamp, Waveform) of the acquisition pipeline.
+        @param timeout: Maximum waiting time in s, None to wait forever
+        """
+        if self._pipeline_queue is None:
+            raise RuntimeError("Acquisition pipeline not running.")
+        start_time = time()
+        while True:
+            if self._pipeline_error is not None:
+                raise self._pipeline_error
+            try:
+                return self._pipeline_queue.get(timeout=0.5)
+            except queue.Empty:
+                if (not self._pipeline_thread.is_alive() and
+                        self._pipeline_error is None):
+                    raise RuntimeError("Acquisition pipeline not running.")
+                if timeout is not None and time() - start_time > timeout:
+                    raise TimeoutError("No record acquired in time.")
+
+    def stop_pipeline(self):
+        # Stop the acquisition thread. Records still in the queue are lost.
+        if self._pipeline_thread is None:
+            return
+        self._pipeline_stop.set()
+        self._pipeline_thread.join()
+        self._pipeline_thread = None
+        self._pipeline_queue = None
+        return
+
     def enable_channels(self, channels):
-        for ch in channels:
-            self._command_wait('CHAN{} ON'.format(str(ch)))
-            self._command_wait('CHAN{}:COUP DC'.format(str(ch)))  # DC 50Ohm
-        for ch in range(1, 4):
-            if ch not in channels:
-                self._command_wait('CHAN{} OFF'.format(str(ch)))
+        with self.batch():
+            for ch in channels:
+                self._set('CHAN{}'.format(str(ch)), 'ON')
+                self._set('CHAN{}:COUP'.format(str(ch)), 'DC')  # DC 50Ohm
+            for ch in range(1, 4):
+                if ch not in channels:
+                    self._set('CHAN{}'.format(str(ch)), 'OFF')
         new_par = []
         new_par.append(self._connection.query('CHAN?'))
         return new_par
         
-    def save(self, filename):
-        savename = "C:\\Users\\Public\\files\\gianluca\\" + filename
-        self._command_wait('EXP:WAV:FAST ON')
-        self._command_wait('EXP:WAV:MULT ON')
-        self._command_wait('RUNSingle')
-        self._command_wait('CHAN1:EXP ON')
-        self._command_wait('CHAN2:EXP ON')
-        self._command_wait("EXP:WAV:NAME '" + savename + ".csv'")
-        # print(self._connection.query("EXP:WAV:NAME?"))
+    def save(self, filename, local_folder=None, remote_folder=REMOTE_FOLDER):
+        """
+        Acquires a single record and exports CH1 and CH2 to a file.
+        @param filename: Name of the file, without extension
+        @param local_folder: If None, a csv file is left on the instrument in
+            remote_folder. Otherwise the binary export is copied over the VISA
+            session to local_folder and deleted from the instrument.
+        @param remote_folder: Folder on the instrument
+        @return: The paths of the local files, or None
+        """
+        savename = remote_folder + filename
+        extension = '.csv' if local_folder is None else '.bin'
+        with self.batch():
+            self._set('EXP:WAV:FAST', 'ON')
+            self._set('EXP:WAV:MULT', 'ON')
+            self._command_wait('RUNSingle')
+            # Export only after the acquisition is finished
+            self._command_wait('*WAI')
+            self._set('CHAN1:EXP', 'ON')
+            self._set('CHAN2:EXP', 'ON')
+            self._command_wait(
+                "EXP:WAV:NAME '" + savename + extension + "'")
+            # print(self._connection.query("EXP:WAV:NAME?"))
+            self._command_wait("MMEM:DEL '" + savename + ".*'")
+            self._command_wait("EXP:WAV:SAVE")
+
+        if local_folder is None:
+            return None
+
+        local_paths = []
+        for suffix in BINARY_EXPORT_SUFFIXES:
+            # The file content is sent as a definite length block. With a
+            # numpy container pyvisa wraps the bytes with np.frombuffer
+            # instead of unpacking one int per byte.
+            data = self._connection.query_binary_values(
+                "MMEM:DATA? '" + savename + suffix + "'", datatype='B',
+                container=np.array)
+            local_path = os.path.join(local_folder, filename + suffix)
+            with open(local_path, 'wb') as f:
+                f.write(data.tobytes())
+            local_paths.append(local_path)
+        # Keep the disk of the instrument free
         self._command_wait("MMEM:DEL '" + savename + ".*'")
-        self._command_wait("EXP:WAV:SAVE")
-        
-        return
+        return local_paths
     
     
     def set_acquisition_type(self, acq):
@@ -103,48 +719,66 @@ class RohdeSchwarzRTO1024:
         
     def set_trigger(self, source_channel=None, level=None, slope=None):
         # source_channel: 'CHAN1', 'CHAN2', 'CHAN2', 'CHAN4', 'EXT'
-        if source_channel is not None:
-            self._command_wait('TRIG1:SOUR {0}'.format(source_channel.upper()))
-            # new_par = self._connection.query('TRIG1:SOUR?')
-        if level is not None:
-            if source_channel == "EXT":
-                trig_n = 5
-            else:
-                trig_n = source_channel[-1]  # 1, 2, 3, 4
-            self._command_wait('TRIG1:LEV{0} {1}'.format(
-                                str(trig_n), str(level)))
-            # new_par = self._connection.query(
-            #     'TRIG1:LEV{}?'.format(str(source_channel)))
-        if slope is not None:
-            self._command_wait('TRIG1:EDGE:SLOP {}'.format(slope))
-            # new_par = self._connection.query('TRIG1:EDGE:SLOP?')
-                
-        self._command_wait('TRIG1:ANED:COUP DC')  # DC 50Ohm
+        with self.batch():
+            if source_channel is not None:
+                self._set('TRIG1:SOUR', source_channel.upper())
+                # new_par = self._connection.query('TRIG1:SOUR?')
+            if level is not None:
+                if source_channel == "EXT":
+                    trig_n = 5
+                else:
+                    trig_n = source_channel[-1]  # 1, 2, 3, 4
+                self._set('TRIG1:LEV{}'.format(str(trig_n)), level)
+                # new_par = self._connection.query(
+                #     'TRIG1:LEV{}?'.format(str(source_channel)))
+            if slope is not None:
+                self._set('TRIG1:EDGE:SLOP', slope)
+                # new_par = self._connection.query('TRIG1:EDGE:SLOP?')
+                    
+            self._set('TRIG1:ANED:COUP', 'DC')  # DC 50Ohm
         return
         
     def set_average(self, chs, counts):
-        for ch in chs:
-            self._command_wait('CHAN{}:ARIT AVER'.format(ch))
-        self._command_wait('ACQ:COUN {}'.format(round(counts)))
+        with self.batch():
+            for ch in chs:
+                self._set('CHAN{}:ARIT'.format(ch), 'AVER')
+            self._set('ACQ:COUN', round(counts))
         return
         
+    def set_segmented(self, chs, nsegments):
+        # Fast segmentation: one RUNSingle acquires nsegments triggers into
+        # the history memory, without display update in between. Read them
+        # with get_segments(). nsegments <= 1 switches segmentation off.
+        with self.batch():
+            if nsegments <= 1:
+                self._set('ACQ:SEGM:STAT', 'OFF')
+                return
+            for ch in chs:
+                # Single shots are wanted, no averaging
+                self._set('CHAN{}:ARIT'.format(ch), 'OFF')
+            self._set('ACQ:SEGM:STAT', 'ON')
+            self._set('ACQ:SEGM:MAX', 'OFF')
+            self._set('ACQ:COUN', round(nsegments))
+        return
+
     def set_timebase_scale(self, scale, offset):
-        
-        self._command_wait('TIM:SCAL {}'.format(scale))
-        new_scale = self._connection.query('TIM:SCAL?')
-        self._command_wait('TIM:HOR:POS {}'.format(offset))
-        new_offset = self._connection.query('TIM:HOR:POS?')
+        self._set('TIM:SCAL', scale)
+        new_scale = self._get('TIM:SCAL')
+        self._set('TIM:HOR:POS', offset)
+        new_offset = self._get('TIM:HOR:POS')
         
         return new_scale, new_offset
         
     def set_resolution(self, res):
-        self._command_wait('ACQ:RES {}'.format(res))
-        new_par = self._connection.query('ACQ:RES?')
+        self._set('ACQ:RES', res)
+        new_par = self._get('ACQ:RES')
         return new_par
         
     def set_yaxis(self, scale1, offset1, scale2, offset2):
-        self._command_wait('CHAN1:SCAL {}'.format(scale1))
-        self._command_wait('CHAN1:OFFS {}'.format(offset1))
-        self._command_wait('CHAN2:SCAL {}'.format(scale2))      
-        self._command_wait('CHAN2:OFFS {}'.format(offset2))          
+        with self.batch():
+            self._set('CHAN1:SCAL', scale1)
+            self._set('CHAN1:OFFS', offset1)
+            self._set('CHAN2:SCAL', scale2)
+            self._set('CHAN2:OFFS', offset2)
+        return
         
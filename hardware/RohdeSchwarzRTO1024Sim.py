@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+# In-process simulation of the RohdeSchwarzRTO1024 oscilloscope. It answers
+# the SCPI messages used by the driver with synthetic trEPR-like waveforms,
+# so that the driver can be used and benchmarked without the instrument:
+#
+#   sim = RohdeSchwarzRTO1024Sim(latency=1e-3)
+#   scope = RohdeSchwarzRTO1024('SIM', connection=sim)
+
+import fnmatch
+import numpy as np
+import pyvisa as visa
+import threading
+from time import sleep, time
+
+# Values returned after *RST for the settings the waveforms depend on
+DEFAULT_SETTINGS = {
+    'FORM:DATA': 'ASC',
+    'FORM:BORD': 'LSBF',
+    'TIM:SCAL': '1e-06',
+    'TIM:HOR:POS': '0',
+    'ACQ:RES': '1e-09',
+    'ACQ:COUN': '1',
+    'ACQ:SEGM:STAT': 'OFF',
+    'EXP:WAV:DLOG': 'OFF',
+}
+for _ch in range(1, 5):
+    DEFAULT_SETTINGS['CHAN%u:SCAL' % _ch] = '0.05'
+    DEFAULT_SETTINGS['CHAN%u:OFFS' % _ch] = '0'
+    DEFAULT_SETTINGS['CHAN%u:POS' % _ch] = '0'
+
+# Number of acquisitions kept in the simulated history memory
+HISTORY_SIZE = 1000
+
+
+class RohdeSchwarzRTO1024Sim:
+    def __init__(self, latency=0., transfer_rate=None, acquisition_time=0.,
+                 noise=0.05, seed=None):
+        """
+        @param latency: Time in s to process every message
+        @param transfer_rate: Bytes per s of the responses, None for no limit
+        @param acquisition_time: Time in s taken by RUNSingle
+        @param noise: Standard deviation of the noise in V
+        @param seed: Seed of the random generator
+        """
+        self.latency = latency
+        self.transfer_rate = transfer_rate
+        self.acquisition_time = acquisition_time
+        self.noise = noise
+        self.timeout = 2000  # ms, as pyvisa resources
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.RLock()
+        self._response = None
+        self._settings = {}
+        self._files = {}
+        self._acq_end = 0.
+        self._opc_pending = False
+        self._esr = 0
+        self._history = []
+        self._playback = None
+        # Event types enabled with enable_event, kept by *RST
+        self._events = set()
+        self._reset()
+
+    def _reset(self):
+        self._settings = dict(DEFAULT_SETTINGS)
+        self._history = []
+        self._playback = None
+        return
+
+    # pyvisa resource interface
+
+    def write(self, message):
+        with self._lock:
+            sleep(self.latency)
+            for i, command in enumerate(message.split(';')):
+                command = command.strip()
+                if i > 0 and command and command[0] not in ':*':
+                    # The instrument would resolve the header relative to
+                    # the previous subsystem: undefined header (-113)
+                    raise ValueError(
+                        f"Relative header '{command}' after ';' in "
+                        f"'{message}', use ';:'.")
+                response = self._execute(command)
+                if response is not None:
+                    self._response = response
+        return
+
+    def read_raw(self):
+        with self._lock:
+            response, self._response = self._response, None
+            if response is None:
+                raise RuntimeError("Query UNTERMINATED: nothing to read.")
+            if isinstance(response, str):
+                response = (response + '\n').encode()
+            if self.transfer_rate:
+                sleep(len(response) / self.transfer_rate)
+            return response
+
+    def read(self):
+        return self.read_raw().decode().rstrip('\n')
+
+    def query(self, message):
+        with self._lock:
+            self.write(message)
+            return self.read()
+
+    def query_binary_values(self, message, datatype='f', is_big_endian=False,
+                            container=list):
+        with self._lock:
+            self.write(message)
+            block = self.read_raw()
+        # IEEE 488.2 definite length block: #<n><length><data>
+        ndigits = int(block[1:2])
+        length = int(block[2:2 + ndigits])
+        dtype = np.dtype(datatype).newbyteorder('>' if is_big_endian else '<')
+        values = np.frombuffer(block, dtype=dtype,
+                               count=length // dtype.itemsize,
+                               offset=2 + ndigits)
+        if container is list:
+            return values.tolist()
+        return container(values)
+
+    def enable_event(self, event_type, mechanism):
+        self._events.add(event_type)
+        return
+
+    def wait_on_event(self, event_type, timeout):
+        # The service request is raised when *OPC sets the event register.
+        # As with VISA, only enabled events can be waited for.
+        if event_type not in self._events:
+            raise visa.errors.VisaIOError(
+                visa.constants.StatusCode.error_not_enabled)
+        start_time = time()
+        while True:
+            with self._lock:
+                self._update_esr()
+                if self._esr & 1:
+                    return
+            if timeout is not None and (time() - start_time) * 1000 > timeout:
+                raise visa.errors.VisaIOError(
+                    visa.constants.StatusCode.error_timeout)
+            sleep(0.001)
+
+    def read_stb(self):
+        with self._lock:
+            self._update_esr()
+            return 32 if self._esr & 1 else 0
+
+    def close(self):
+        return
+
+    # SCPI
+
+    def _update_esr(self):
+        if self._opc_pending and time() >= self._acq_end:
+            self._opc_pending = False
+            self._esr |= 1
+        return
+
+    def _wait_acquisition(self):
+        remaining = self._acq_end - time()
+        if remaining > 0:
+            sleep(remaining)
+        return
+
+    def _execute(self, command):
+        if not command:
+            return None
+        header, _, value = command.partition(' ')
+        header = header.upper().lstrip(':')
+        value = value.strip()
+
+        if header == '*IDN?':
+            return 'Rohde&Schwarz,RTO1024-SIM,000000/000,0.0'
+        if header == '*RST':
+            self._reset()
+            return None
+        if header == '*CLS':
+            self._esr = 0
+            return None
+        if header == '*WAI':
+            self._wait_acquisition()
+            return None
+        if header == '*OPC?':
+            self._wait_acquisition()
+            return '1'
+        if header == '*OPC':
+            self._opc_pending = True
+            return None
+        if header == '*ESR?':
+            self._update_esr()
+            esr, self._esr = self._esr, 0
+            return str(esr)
+        if header in ('RUNSINGLE', 'RUNS'):
+            self._acquire()
+            return None
+        if header in ('RUNC', 'STOP'):
+            return None
+        if header.endswith(':HIST:PLAY'):
+            channel = int(header[4])
+            start = int(float(self._settings.get(header[:5] + ':HIST:STAR',
+                                                 0)))
+            stop = int(float(self._settings.get(header[:5] + ':HIST:STOP',
+                                                0)))
+            # Only the acquisitions in the history are played back
+            n = len(self._history)
+            self._playback = [self._history[n - 1 + i][channel - 1]
+                              for i in range(max(start, 1 - n), stop + 1)]
+            return None
+        if header == 'MMEM:DATA?':
+            return self._block(self._files.get(value.strip("'"), b''))
+        if header == 'MMEM:DEL':
+            for name in fnmatch.filter(list(self._files), value.strip("'")):
+                del self._files[name]
+            return None
+        if header == 'EXP:WAV:SAVE':
+            self._export()
+            return None
+        if header.endswith(':DATA:VALUES?') or header.endswith(':DATA?'):
+            return self._values(int(header[4]))
+        if header.endswith(':DATA:HEADER?'):
+            # Whole record, also with EXP:WAV:SCOP MAN
+            return '{},{},{},1'.format(*self._time_axis())
+        if header.endswith('?'):
+            return self._settings.get(header[:-1], '0')
+        self._settings[header] = value
+        return None
+
+    def _time_axis(self):
+        scale = float(self._settings['TIM:SCAL'])
+        position = float(self._settings['TIM:HOR:POS'])
+        resolution = float(self._settings['ACQ:RES'])
+        npoints = int(round(10 * scale / resolution)) + 1
+        start = position - 5 * scale
+        return start, start + 10 * scale, npoints
+
+    def _export_axis(self):
+        # Time axis of the transferred data, restricted by EXP:WAV:SCOP MAN
+        t = np.linspace(*self._time_axis())
+        if self._settings.get('EXP:WAV:SCOP') == 'MAN':
+            start = float(self._settings.get('EXP:WAV:STAR', t[0]))
+            stop = float(self._settings.get('EXP:WAV:STOP', t[-1]))
+            t = t[(t >= start) & (t <= stop)]
+        return t
+
+    def _acquire(self):
+        # Every trigger produces one record per channel. Segmented
+        # acquisitions store ACQ:COUN records in the history.
+        if self._settings['ACQ:SEGM:STAT'] == 'ON':
+            ntriggers = int(float(self._settings['ACQ:COUN']))
+        else:
+            ntriggers = 1
+        for _ in range(ntriggers):
+            self._history.append(self._synthetic_record())
+        del self._history[:-HISTORY_SIZE]
+        self._playback = None
+        self._acq_end = time() + self.acquisition_time
+        return
+
+    def _synthetic_record(self):
+        # Transient signal after a flash at t = 0: in-phase (CH1) and
+        # quadrature (CH2) components with a random phase, plus noise
+        start, stop, npoints = self._time_axis()
+        t = np.linspace(start, stop, npoints)
+        t_flash = np.clip(t, 0, None)
+        decay = np.exp(-t_flash / 2e-6) * (1 - np.exp(-t_flash / 5e-8))
+        phase = self._rng.uniform(0, 2 * np.pi)
+        record = []
+        for ch_phase in (0, np.pi / 2, 0, 0):
+            y = 0.5 * np.cos(phase + ch_phase) * decay
+            y += self._rng.normal(0, self.noise, npoints)
+            record.append(y.astype(np.float32))
+        return record
+
+    def _export(self):
+        # Write the exported channels of the last record to the simulated
+        # disk: csv, or binary as XML header (.bin) and data (.Wfm.bin)
+        name = self._settings.get('EXP:WAV:NAME', "'export.csv'").strip("'")
+        if not self._history:
+            self._history.append(self._synthetic_record())
+        channels = [ch for ch in range(1, 5)
+                    if self._settings.get('CHAN%u:EXP' % ch) == 'ON']
+        y = np.stack([self._history[-1][ch - 1] for ch in channels], axis=1)
+        start, stop, npoints = self._time_axis()
+        if name.endswith('.bin'):
+            self._files[name] = (
+                '<Database><Prop Name="XStart" Value="{}"/>'
+                '<Prop Name="XStop" Value="{}"/>'
+                '<Prop Name="RecordLength" Value="{}"/></Database>'.format(
+                    start, stop, npoints)).encode()
+            self._files[name[:-len('.bin')] + '.Wfm.bin'] = \
+                y.astype('<f4').tobytes()
+        else:
+            self._files[name] = '\n'.join(
+                ','.join('{:.6e}'.format(v) for v in row) for row in y
+            ).encode()
+        return
+
+    def _values(self, channel):
+        if not self._history:
+            self._history.append(self._synthetic_record())
+        if (self._playback is not None and
+                self._settings['EXP:WAV:DLOG'] == 'ON'):
+            y = np.concatenate(self._playback) if self._playback \
+                else np.zeros(0)
+        else:
+            y = self._history[-1][channel - 1]
+            if self._settings.get('EXP:WAV:SCOP') == 'MAN':
+                t = np.linspace(*self._time_axis())
+                t_export = self._export_axis()
+                y = y[(t >= t_export[0]) & (t <= t_export[-1])]
+
+        data_format = self._settings['FORM:DATA'].upper()
+        if data_format.startswith('ASC'):
+            return ','.join('{:.6e}'.format(v) for v in y)
+        byteorder = '>' if self._settings['FORM:BORD'].startswith('MSB') \
+            else '<'
+        if data_format.startswith('REAL'):
+            return self._block(y.astype(byteorder + 'f4').tobytes())
+        # Integer formats: ADC levels, see RohdeSchwarzRTO1024._int_to_volts
+        nbits = 8 if data_format.endswith('8') else 16
+        scale = float(self._settings.get('CHAN%u:SCAL' % channel, '0.05'))
+        offset = float(self._settings.get('CHAN%u:OFFS' % channel, '0'))
+        position = float(self._settings.get('CHAN%u:POS' % channel, '0'))
+        lsb = 10 * scale / (253 * 2**(nbits - 8))
+        raw = np.round((y - offset + position * scale) / lsb)
+        limit = 2**(nbits - 1)
+        raw = np.clip(raw, -limit, limit - 1)
+        dtype = byteorder + ('i1' if nbits == 8 else 'i2')
+        return self._block(raw.astype(dtype).tobytes())
+
+    @staticmethod
+    def _block(data):
+        length = str(len(data))
+        return b'#' + str(len(length)).encode() + length.encode() + data + \
+            b'\n'
+
+
+if __name__ == '__main__':
+    # Benchmark of the transfer formats over a simulated link
+    # python -m hardware.RohdeSchwarzRTO1024Sim
+    from hardware.RohdeSchwarzRTO1024 import RohdeSchwarzRTO1024
+
+    sim = RohdeSchwarzRTO1024Sim(latency=1e-3, transfer_rate=50e6)
+    scope = RohdeSchwarzRTO1024('SIM', connection=sim)
+    scope.set_timebase_scale(1e-5, 0)
+    scope.set_resolution(1e-10)
+    for data_format in ('ASCii', 'REAL,32', 'INT,16', 'INT,8'):
+        start_time = time()
+        for _ in range(10):
+            wfm = scope.get_channels([1, 2], data_format)
+        print('{:8s} {} points: {:.1f} ms per record'.format(
+            data_format, wfm.npoints, (time() - start_time) * 100))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Shared VISA sessions. VisaSession.open(address) returns the session that
+# is already open to address, if any, so that several driver instances (or a
+# script run again in the same interpreter) reuse the connection. After a
+# timeout or a lost connection the resource is reopened. Only queries are
+# then repeated once: a repeated write could arm or export twice, so the
+# error is raised for the caller to decide.
+
+import pyvisa as visa
+import threading
+
+# VISA errors after which the resource is reopened
+RECONNECT_ERRORS = (
+    visa.constants.StatusCode.error_timeout,
+    visa.constants.StatusCode.error_connection_lost,
+    visa.constants.StatusCode.error_io,
+)
+
+
+class VisaSession:
+    _rm = None
+    _sessions = {}
+    _lock = threading.Lock()
+
+    def __init__(self, address, timeout=None):
+        """
+        Use VisaSession.open() to share the session with other users.
+        @param address: VISA resource address
+        @param timeout: VISA timeout in ms, None for the default
+        """
+        self.address = address
+        self.timeout_ms = timeout
+        self.nusers = 0
+        self.nreconnects = 0
+        self._resource = None
+        # Events enabled on the resource, enabled again after reconnecting
+        self._events = []
+        # Shadow copy of the instrument settings for the drivers using the
+        # session (written and read back values, keyed by SCPI header),
+        # cleared when the resource is reopened
+        self.written = {}
+        self.readback = {}
+        self._open()
+
+    @classmethod
+    def open(cls, address, timeout=None):
+        # Return the shared session to address, opened if needed. A timeout
+        # given for an existing session replaces its timeout for all users.
+        with cls._lock:
+            session = cls._sessions.get(address)
+            if session is None:
+                session = cls(address, timeout)
+                cls._sessions[address] = session
+            elif timeout is not None and timeout != session.timeout_ms:
+                session.timeout_ms = timeout
+                session._resource.timeout = timeout
+            session.nusers += 1
+            return session
+
+    @classmethod
+    def resource_manager(cls):
+        if cls._rm is None:
+            cls._rm = visa.ResourceManager()
+        return cls._rm
+
+    def _open(self):
+        try:
+            self._resource = self.resource_manager().open_resource(
+                self.address)
+        except Exception as e:
+            raise ConnectionError(
+                "Could not open VISA resource {}: {}".format(self.address, e)
+            ) from e
+        if self.timeout_ms is not None:
+            self._resource.timeout = self.timeout_ms
+        for event_type, mechanism in self._events:
+            self._resource.enable_event(event_type, mechanism)
+        return
+
+    def reconnect(self):
+        try:
+            self._resource.close()
+        except Exception:
+            pass
+        self._open()
+        self.nreconnects += 1
+        # The instrument may have been restarted
+        self.written.clear()
+        self.readback.clear()
+        return
+
+    def is_alive(self):
+        # Health check: the instrument answers *IDN?
+        try:
+            self._resource.query('*IDN?')
+            return True
+        except Exception:
+            return False
+
+    def release(self):
+        # Called by a user that does not need the session anymore. The
+        # resource is closed when the last user releases it.
+        with self._lock:
+            self.nusers -= 1
+            if self.nusers > 0:
+                return
+            if self._sessions.get(self.address) is self:
+                del self._sessions[self.address]
+        self.close()
+        return
+
+    def close(self):
+        self._resource.close()
+        return
+
+    @staticmethod
+    def is_query(message):
+        # True if every command of the message is a query, e.g.
+        # 'CHAN1:DATA:HEADER?;*OPC?', so that it can be sent again
+        return all(command.strip().split(' ')[0].endswith('?')
+                   for command in message.split(';'))
+
+    def _call(self, name, message=None, *args, **kwargs):
+        call_args = args if message is None else (message,) + args
+        try:
+            return getattr(self._resource, name)(*call_args, **kwargs)
+        except visa.errors.VisaIOError as e:
+            if e.error_code not in RECONNECT_ERRORS:
+                raise
+            self.reconnect()
+            if name == 'write' or message is None or \
+                    not self.is_query(message):
+                # Not repeated, the instrument may have executed it
+                raise
+        return getattr(self._resource, name)(*call_args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._resource, name)
+
+    def write(self, message):
+        return self._call('write', message)
+
+    def query(self, message):
+        return self._call('query', message)
+
+    def query_binary_values(self, message, **kwargs):
+        return self._call('query_binary_values', message, **kwargs)
+
+    def read_raw(self):
+        return self._call('read_raw')
+
+    def enable_event(self, event_type, mechanism):
+        self._resource.enable_event(event_type, mechanism)
+        self._events.append((event_type, mechanism))
+        return
+
+    def wait_on_event(self, event_type, timeout):
+        # A timeout here means no event, not a lost connection
+        return self._resource.wait_on_event(event_type, timeout)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Append-only recorder of oscilloscope records. Each record (Waveform of
+# RohdeSchwarzRTO1024) is written to disk as soon as it is acquired:
+#   <path>.dat       raw y values of all the records, one after the other
+#   <path>.idx.jsonl one JSON line per record with offset, shape, dtype,
+#                    time axis (start, stop, npoints) and timestamp
+# The index line is written after the data, so a reader only sees complete
+# records and can open the file while the acquisition is running.
+
+import json
+import numpy as np
+import os
+from time import time
+
+
+class WaveformRecorder:
+    def __init__(self, path, dtype=np.float32, fsync=False):
+        """
+        @param path: Path of the files, without extension
+        @param dtype: Data type the y values are stored with
+        @param fsync: Force the data to disk after each record
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.fsync = fsync
+        self._data_file = open(path + '.dat', 'ab')
+        self._index_file = open(path + '.idx.jsonl', 'a')
+        self.nrecords = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, wfm, timestamp=None):
+        """
+        Writes one record.
+        @param wfm: Waveform returned by get_waveform, get_channels or
+            get_segments
+        @param timestamp: Acquisition time in s since the epoch, now if None
+        """
+        y = np.ascontiguousarray(wfm.y, dtype=self.dtype)
+        offset = self._data_file.tell()
+        self._data_file.write(y.tobytes())
+        self._data_file.flush()
+        if self.fsync:
+            os.fsync(self._data_file.fileno())
+
+        entry = {
+            'offset': offset,
+            'shape': list(y.shape),
+            'dtype': y.dtype.str,
+            'start': wfm.start,
+            'stop': wfm.stop,
+            'npoints': wfm.npoints,
+            'timestamp': time() if timestamp is None else timestamp,
+        }
+        self._index_file.write(json.dumps(entry) + '\n')
+        self._index_file.flush()
+        if self.fsync:
+            os.fsync(self._index_file.fileno())
+        self.nrecords += 1
+        return
+
+    def close(self):
+        self._data_file.close()
+        self._index_file.close()
+        return
+
+
+def read_index(path):
+    # Return the index entries of the complete records in path
+    entries = []
+    with open(path + '.idx.jsonl') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # Line being written
+                break
+            entries.append(json.loads(line))
+    return entries
+
+
+def read_records(path):
+    """
+    Opens the records written by a WaveformRecorder without copying them.
+    @param path: Path of the files, without extension
+    @return: (data, index). If all the records have the same shape and dtype,
+        data is a read-only np.memmap of shape (nrecords, *shape), otherwise
+        a list with one np.memmap per record.
+    """
+    index = read_index(path)
+    if not index:
+        return np.empty(0), index
+
+    shapes = {(tuple(entry['shape']), entry['dtype']) for entry in index}
+    if len(shapes) == 1:
+        shape, dtype = next(iter(shapes))
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        contiguous = all(entry['offset'] == i * nbytes
+                         for i, entry in enumerate(index))
+    if len(shapes) == 1 and contiguous:
+        data = np.memmap(path + '.dat', dtype=dtype, mode='r',
+                         shape=(len(index),) + shape)
+        return data, index
+
+    data = [np.memmap(path + '.dat', dtype=entry['dtype'], mode='r',
+                      offset=entry['offset'], shape=tuple(entry['shape']))
+            for entry in index]
+    return data, index
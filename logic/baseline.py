@@ -0,0 +1,344 @@
+# Polynomial baseline correction with cached projections
+from collections import OrderedDict
+import numpy as np
+import threading
+
+try:
+    from scipy.linalg import solveh_banded
+except ImportError:
+    # Only needed by als_baseline
+    solveh_banded = None
+
+
+class BaselineCorrector():
+
+    def __init__(self, maxsize=32):
+        # (npoints, n, region) -> (D, pseudo-inverse of D[region]), the least
+        # recently used entry is dropped when maxsize is exceeded
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        # Used from the measurement thread and the GUI
+        self._lock = threading.Lock()
+
+    def correct(self, data, dim=0, n=0, region=None):
+        """
+        Subtracts a polynomial baseline fitted to region along dim.
+        @param data: 1D or 2D array
+        @param dim: Dimension along which the baseline is fitted
+        @param n: Polynomial order
+        @param region: Boolean mask of the baseline points along dim, None
+            to fit all the points
+        @return: Corrected data and baseline, same shape as data
+        """
+        if data.ndim > 2:
+            raise ValueError(
+                f"Only 1D or 2D data supported, got ndim={data.ndim}.")
+
+        if dim not in (0, 1) or dim >= data.ndim:
+            raise ValueError("dim must be 0, 1. Only 1D or 2D data supported.")
+
+        if isinstance(n, (list, tuple, np.ndarray)):
+            if len(n) != 1:
+                raise ValueError(
+                    "For 1D fit, polynomial order n must be a scalar")
+            n = n[0]
+
+        if n >= data.shape[dim]:
+            raise ValueError(
+                f"Polynomial order n={n} must be smaller than "
+                f"data size {data.shape[dim]}"
+            )
+
+        # The dimension along which the data is corrected must be dim 0
+        data2d = data.reshape(data.size, 1) if data.ndim == 1 else data
+        if dim == 1:
+            data2d = data2d.T
+
+        D, pinv, region = self.projection(data2d.shape[0], n, region)
+        baseline = D @ (pinv @ data2d[region, :])
+
+        if dim == 1:
+            baseline = baseline.T
+        baseline = baseline.reshape(data.shape)
+        return data - baseline, baseline
+
+    def correct_batch(self, datasets, dim=0, n=0, region=None):
+        """
+        Corrects a stack of datasets with one matrix product, same as
+        calling correct() on each of them.
+        @param datasets: Array of shape (n_datasets, ...) or list of arrays
+            with the same shape (1D or 2D)
+        @param dim: Dimension of each dataset along which the baseline is
+            fitted
+        @return: Corrected data and baselines, shape (n_datasets, ...)
+        """
+        if isinstance(datasets, np.ndarray):
+            stack = datasets
+        else:
+            stack = np.stack(datasets)
+        if stack.ndim not in (2, 3):
+            raise ValueError(
+                "Only stacks of 1D or 2D data supported, got "
+                f"ndim={stack.ndim}.")
+        if dim not in (0, 1) or dim >= stack.ndim - 1:
+            raise ValueError("dim must be 0, 1. Only 1D or 2D data supported.")
+
+        if isinstance(n, (list, tuple, np.ndarray)):
+            if len(n) != 1:
+                raise ValueError(
+                    "For 1D fit, polynomial order n must be a scalar")
+            n = n[0]
+
+        npoints = stack.shape[dim + 1]
+        if n >= npoints:
+            raise ValueError(
+                f"Polynomial order n={n} must be smaller than "
+                f"data size {npoints}"
+            )
+
+        # All the datasets side by side as columns of one matrix
+        moved = np.moveaxis(stack, dim + 1, 0)
+        columns = moved.reshape(npoints, -1)
+        D, pinv, region = self.projection(npoints, n, region)
+        baseline = (D @ (pinv @ columns[region, :])).reshape(moved.shape)
+        baseline = np.moveaxis(baseline, 0, dim + 1)
+        return stack - baseline, baseline
+
+    def projection(self, npoints, n, region=None):
+        """
+        Vandermonde matrix D of the polynomial and pseudo-inverse of
+        D[region], so that the baseline of y is D @ (pinv @ y[region]).
+        @return: D, pinv and region as a boolean mask
+        """
+        if region is None:
+            region = np.ones(npoints, dtype=bool)
+        region = np.asarray(region, dtype=bool)
+        if region.size != npoints:
+            raise ValueError("Region length must match data dimension")
+
+        key = (npoints, int(n), np.packbits(region).tobytes())
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                D, pinv = self._cache[key]
+                return D, pinv, region
+
+        x = np.linspace(-1, 1, npoints)
+        # Vandermonde matrix shape (len(x), n+1)
+        D = x[:, None] ** np.arange(n + 1)[None, :]
+        # Same solution as np.linalg.lstsq, also for rank deficient D[region]
+        pinv = np.linalg.pinv(D[region])
+        with self._lock:
+            self._cache[key] = (D, pinv)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return D, pinv, region
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        return
+
+
+def _traces(data, dim):
+    # data as a (npoints, ntraces) matrix with the traces along dim
+    if data.ndim > 2:
+        raise ValueError(
+            f"Only 1D or 2D data supported, got ndim={data.ndim}.")
+    if dim not in (0, 1) or dim >= data.ndim:
+        raise ValueError("dim must be 0, 1. Only 1D or 2D data supported.")
+    if data.ndim == 1:
+        return data.reshape(data.size, 1)
+    return data if dim == 0 else data.T
+
+
+def _untraces(baseline, data, dim):
+    # Inverse of _traces
+    if data.ndim == 2 and dim == 1:
+        baseline = baseline.T
+    return baseline.reshape(data.shape)
+
+
+def als_baseline(data, dim=0, lam=1e7, p=0.01, niter=10):
+    """
+    Asymmetric least squares baseline (Eilers and Boelens, 2005): smooth
+    curve z minimizing sum(w*(y - z)**2) + lam*sum(diff(z, 2)**2), with
+    weight p where y > z and 1 - p elsewhere. O(N) per iteration.
+    @param data: 1D or 2D array, complex data is corrected part by part
+    @param dim: Dimension along which the baseline is estimated
+    @param lam: Smoothness, larger for a stiffer baseline. Scales with
+        npoints**4 for the same stiffness relative to the axis.
+    @param p: Asymmetry, small for positive lines on the baseline
+    @param niter: Maximum number of reweighting iterations
+    @return: Baseline, same shape as data
+    """
+    if solveh_banded is None:
+        raise ImportError("als_baseline needs scipy.")
+    if np.iscomplexobj(data):
+        return (als_baseline(data.real, dim, lam, p, niter)
+                + 1j * als_baseline(data.imag, dim, lam, p, niter))
+
+    y = _traces(np.asarray(data, dtype=float), dim)
+    npoints, ntraces = y.shape
+    if npoints < 3:
+        raise ValueError("At least 3 points needed along dim.")
+
+    # lam * D.T @ D of the second differences D of each trace, in upper
+    # banded form. All the traces are solved at once as a block diagonal
+    # system, the bands are zero between two traces.
+    d0 = np.full(npoints, 6.)
+    d0[[0, -1]] = 1.
+    d0[[1, -2]] = 5.
+    d1 = np.full(npoints, -4.)
+    d1[[0, -2]] = -2.
+    d1[-1] = 0.
+    d2 = np.ones(npoints)
+    d2[-2:] = 0.
+    ab = np.zeros((3, npoints * ntraces))
+    ab[0, 2:] = lam * np.tile(d2, ntraces)[:-2]
+    ab[1, 1:] = lam * np.tile(d1, ntraces)[:-1]
+    penalty = lam * np.tile(d0, ntraces)
+
+    yflat = y.T.ravel()
+    w = np.ones_like(yflat)
+    for _ in range(niter):
+        ab[2] = penalty + w
+        z = solveh_banded(ab, w * yflat, check_finite=False)
+        w_new = np.where(yflat > z, p, 1. - p)
+        if np.array_equal(w_new, w):
+            break
+        w = w_new
+    return _untraces(z.reshape(ntraces, npoints).T, data, dim)
+
+
+def reweighted_polynomial_baseline(data, dim=0, n=3, niter=20, c=4.685):
+    """
+    Polynomial baseline fitted to all the points with iteratively
+    reweighted least squares (Tukey bisquare weights), so that lines of
+    either sign are ignored without choosing a baseline region.
+    @param data: 1D or 2D array, complex data is corrected part by part
+    @param dim: Dimension along which the baseline is fitted
+    @param n: Polynomial order
+    @param niter: Maximum number of reweighting iterations
+    @param c: Residuals larger than c times the robust noise estimate get
+        zero weight
+    @return: Baseline, same shape as data
+    """
+    if np.iscomplexobj(data):
+        return (reweighted_polynomial_baseline(data.real, dim, n, niter, c)
+                + 1j * reweighted_polynomial_baseline(data.imag, dim, n,
+                                                      niter, c))
+
+    y = _traces(np.asarray(data, dtype=float), dim)
+    npoints = y.shape[0]
+    if n >= npoints:
+        raise ValueError(
+            f"Polynomial order n={n} must be smaller than "
+            f"data size {npoints}"
+        )
+    x = np.linspace(-1, 1, npoints)
+    D = x[:, None] ** np.arange(n + 1)[None, :]
+
+    w = np.ones_like(y)
+    baseline = np.zeros_like(y)
+    for _ in range(niter):
+        # Weighted normal equations of all the traces, shape (ntraces, n+1,
+        # n+1) and (ntraces, n+1)
+        A = np.einsum('ik,ij,il->kjl', w, D, D)
+        b = np.einsum('ik,ij->kj', w * y, D)
+        p = np.linalg.solve(A, b[..., None])[..., 0]
+        new_baseline = D @ p.T
+        resid = y - new_baseline
+        # Noise from the median absolute deviation of each trace
+        scale = 1.4826 * np.median(np.abs(resid), axis=0)
+        scale[scale == 0] = np.finfo(float).tiny
+        u = resid / (c * scale)
+        w = np.where(np.abs(u) < 1, (1 - u**2)**2, 0.)
+        converged = np.allclose(new_baseline, baseline, rtol=1e-6,
+                                atol=1e-9 * np.max(np.abs(y)))
+        baseline = new_baseline
+        if converged:
+            break
+    return _untraces(baseline, data, dim)
+
+
+class BaselineMasks():
+
+    def __init__(self, maxsize=64):
+        # (axis fingerprint, bl_type, region) -> read-only boolean mask, the
+        # least recently used entry is dropped when maxsize is exceeded
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, x, bl_type="width", region=0.15, kind="mask"):
+        """
+        Baseline points of the axis x.
+        @param bl_type: "width" for the fraction region of the axis span at
+            both ends, "range" for a list of [start, stop] ranges in units
+            of x (bounds included)
+        @param kind: "mask" for a boolean mask, "slices" for a list of
+            slices of the consecutive baseline points
+        @return: Read-only mask or list of slices, shared between calls
+        """
+        x = np.asarray(x)
+        if bl_type == "width":
+            spec = float(region)
+        else:
+            spec = tuple((float(start), float(stop)) for start, stop in region)
+        key = (x.size, x.dtype.str, hash(x.tobytes()), bl_type, spec)
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                mask, slices = self._cache[key]
+                return mask if kind == "mask" else slices
+
+        if bl_type == "width":
+            left = np.min(x) + (np.max(x) - np.min(x)) * spec
+            right = np.max(x) - (np.max(x) - np.min(x)) * spec
+            # x <= left or x >= right
+            ranges = [(-np.inf, left), (right, np.inf)]
+        else:
+            ranges = spec
+        mask = self._build_mask(x, ranges)
+        mask.flags.writeable = False
+        edges = np.flatnonzero(np.diff(mask.astype(np.int8),
+                                       prepend=0, append=0))
+        slices = [slice(int(start), int(stop))
+                  for start, stop in zip(edges[::2], edges[1::2])]
+
+        with self._lock:
+            self._cache[key] = (mask, slices)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return mask if kind == "mask" else slices
+
+    @staticmethod
+    def _build_mask(x, ranges):
+        # Points with start <= x <= stop for any of the ranges
+        mask = np.zeros(x.size, dtype=bool)
+        if x.size > 1 and np.all(x[1:] >= x[:-1]):
+            increasing = True
+        elif x.size > 1 and np.all(x[1:] <= x[:-1]):
+            increasing = False
+        else:
+            for start, stop in ranges:
+                mask |= (x >= start) & (x <= stop)
+            return mask
+
+        # Sorted axis: O(log N) per range
+        xs = x if increasing else x[::-1]
+        for start, stop in ranges:
+            i0 = np.searchsorted(xs, start, side="left")
+            i1 = np.searchsorted(xs, stop, side="right")
+            if increasing:
+                mask[i0:i1] = True
+            else:
+                mask[x.size - i1:x.size - i0] = True
+        return mask
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        return
@@ -0,0 +1,218 @@
+# Bruker BES3T files: descriptor (.DSC) and data (.DTA)
+from datetime import datetime
+import numpy as np
+import os
+import shutil
+
+# Standard parameter layer entries copied from the Xepr datasets
+SPL_KEYS = ['MWFQ', 'MWPW', 'AVGS', 'A1CT', 'A1SW', 'B0MA', 'B0MF', 'RCAG',
+            'RCTC', 'SPTP', 'STMP']
+
+# Data types of IRFMT/IIFMT, XFMT, YFMT
+BES3T_FORMATS = {'C': 'i1', 'S': 'i2', 'I': 'i4', 'F': 'f4', 'D': 'f8'}
+
+
+def write_bes3t(path, o, x, y=None, title="", params=None):
+    """
+    Writes a 1D or 2D dataset as BES3T files path.DSC and path.DTA.
+    @param path: Path of the files, without extension
+    @param o: Ordinate, shape (len(x),) or (len(y), len(x)), real or complex
+    @param x: Abscissa 1
+    @param y: Abscissa 2 for 2D data
+    @param title: Title of the dataset
+    @param params: dict of standard parameter layer entries, e.g. MWFQ
+    """
+    o = np.asarray(o)
+    x = np.asarray(x)
+    is_complex = np.iscomplexobj(o)
+
+    desc = [
+        ('DSRC', 'EXP'),
+        ('BSEQ', 'BIG'),
+        ('IKKF', 'CPLX' if is_complex else 'REAL'),
+        ('XTYP', 'IDX'),
+        ('YTYP', 'NODATA' if y is None else 'IDX'),
+        ('ZTYP', 'NODATA'),
+        ('IRFMT', 'D'),
+        ('XPTS', len(x)),
+        ('XMIN', x[0]),
+        ('XWID', x[-1] - x[0]),
+    ]
+    if is_complex:
+        desc.append(('IIFMT', 'D'))
+    if y is not None:
+        y = np.asarray(y)
+        desc += [('YPTS', len(y)), ('YMIN', y[0]), ('YWID', y[-1] - y[0])]
+    desc.append(('TITL', f"'{title}'"))
+
+    lines = ['#DESC\t1.2 * DESCRIPTOR INFORMATION *']
+    lines += [f"{key}\t{value}" for key, value in desc]
+    lines.append('*')
+    lines.append('#SPL\t1.2 * STANDARD PARAMETER LAYER')
+    for key, value in (params or {}).items():
+        lines.append(f"{key}\t{value}")
+    lines.append('*')
+    with open(path + '.DSC', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    # Big endian float64, real and imaginary parts interleaved
+    if is_complex:
+        data = np.empty(o.shape + (2,), dtype='>f8')
+        data[..., 0] = o.real
+        data[..., 1] = o.imag
+    else:
+        data = o.astype('>f8')
+    data.tofile(path + '.DTA')
+
+
+def write_bes3t_like(path, template, o, title=None, params=None,
+                     timestamp=None):
+    """
+    Writes a dataset with the descriptor of another one, e.g. written by
+    Xepr, so that all its parameter layers (device, manipulation history,
+    axis names and units) are kept.
+    @param path: Path of the files, without extension
+    @param template: Path of the template dataset, without extension. Its
+        axis files (.XGF, .YGF), if any, are copied.
+    @param o: Ordinate, same shape as the data of the template
+    @param title: New TITL, None to keep the one of the template
+    @param params: dict of entries whose value is replaced, e.g. MWFQ
+    @param timestamp: datetime of the acquisition written as DATE and TIME,
+        None for now
+    """
+    o = np.asarray(o)
+    with open(template + '.DSC', errors='replace') as f:
+        template_text = f.read()
+    desc = read_dsc_text(template_text)
+    shape = tuple(int(desc.get(f'{axis}PTS', 1)) for axis in 'ZYX'
+                  if axis == 'X' or desc.get(f'{axis}TYP',
+                                             'NODATA') != 'NODATA')
+    if o.shape != shape:
+        raise ValueError(
+            f"Data shape {o.shape} does not match the template {shape}.")
+
+    new_values = dict(params or {})
+    if title is not None:
+        new_values['TITL'] = f"'{title}'"
+    if timestamp is None:
+        timestamp = datetime.now()
+    new_values['DATE'] = timestamp.strftime("'%m/%d/%y'")
+    new_values['TIME'] = timestamp.strftime("'%H:%M:%S'")
+    lines = []
+    for line in template_text.splitlines():
+        fields = line.split(None, 1)
+        if fields and fields[0] in new_values and line[0] not in '#*.':
+            line = f"{fields[0]}\t{new_values[fields[0]]}"
+        lines.append(line)
+    with open(path + '.DSC', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    # Data type and byte order of the template
+    byteorder = '>' if desc.get('BSEQ', 'BIG') == 'BIG' else '<'
+    dtype = byteorder + BES3T_FORMATS[str(desc.get('IRFMT', 'D'))
+                                      .split(',')[0]]
+    if str(desc.get('IKKF', 'REAL')).split(',')[0] == 'CPLX':
+        data = np.empty(o.shape + (2,), dtype=dtype)
+        data[..., 0] = o.real
+        data[..., 1] = o.imag
+    else:
+        data = np.real(o).astype(dtype)
+    data.tofile(path + '.DTA')
+
+    for ext in ('.XGF', '.YGF', '.ZGF', '.XGA', '.YGA', '.ZGA'):
+        if os.path.exists(template + ext):
+            shutil.copyfile(template + ext, path + ext)
+
+
+def read_dsc(path):
+    # Return the key-value pairs of the descriptor file path
+    with open(path, errors='replace') as f:
+        return read_dsc_text(f.read())
+
+
+def read_dsc_text(text):
+    # Return the key-value pairs of the text of a descriptor file
+    params = {}
+    lines = text.replace('\\\n', '').splitlines()
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in '#*.':
+            # Section headers, comments, device descriptions
+            continue
+        key, value = (line.split(None, 1) + [''])[:2]
+        value = value.strip()
+        if value.startswith("'"):
+            # Quoted strings stay strings, e.g. TITL '20241205'
+            params[key] = value.strip("'")
+            continue
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+        params[key] = value
+    return params
+
+
+def _axis(path, params, axis):
+    # Abscissa axis ('X', 'Y' or 'Z'), None if not present
+    npoints = int(params.get(f'{axis}PTS', 0))
+    axis_type = params.get(f'{axis}TYP', 'NODATA')
+    if axis_type == 'NODATA' or npoints == 0:
+        return None
+    if axis_type == 'IGD':
+        # Values in a separate file, e.g. path.YGF (older Xepr: .YGA)
+        for ext in (f'.{axis}GF', f'.{axis}GA'):
+            try:
+                byteorder = '>' if params.get('BSEQ', 'BIG') == 'BIG' \
+                    else '<'
+                dtype = byteorder + BES3T_FORMATS[params.get(f'{axis}FMT',
+                                                             'D')]
+                return np.fromfile(path + ext, dtype=dtype, count=npoints)
+            except FileNotFoundError:
+                continue
+    # Linear axis
+    start = params.get(f'{axis}MIN', 0.)
+    width = params.get(f'{axis}WID', npoints - 1)
+    return np.linspace(start, start + width, npoints)
+
+
+def read_bes3t(path):
+    """
+    Reads a BES3T dataset without Xepr. The data file is memory-mapped.
+    @param path: Path of the .DSC, .DTA or .YGA file, or without extension
+    @return: dict with o (ordinate, np.memmap for real or complex
+        floating-point data), x, y (None for 1D data), title and params (all
+        the descriptor entries). Only the first component of IKKF is read.
+    """
+    root, ext = os.path.splitext(path)
+    if ext.upper() in ('.DSC', '.DTA', '.YGA', '.YGF', '.XGF', '.XGA'):
+        path = root
+    params = read_dsc(path + '.DSC')
+
+    byteorder = '>' if params.get('BSEQ', 'BIG') == 'BIG' else '<'
+    is_complex = str(params.get('IKKF', 'REAL')).split(',')[0] == 'CPLX'
+    fmt = BES3T_FORMATS[str(params.get('IRFMT', 'D')).split(',')[0]]
+    shape = [int(params.get(f'{axis}PTS', 1)) for axis in 'ZYX']
+    shape = tuple(n for n, axis in zip(shape, 'ZYX')
+                  if axis == 'X' or params.get(f'{axis}TYP',
+                                               'NODATA') != 'NODATA')
+
+    if is_complex and fmt in ('f4', 'f8'):
+        # Real and imaginary parts interleaved: complex dtype, no copy
+        dtype = byteorder + ('c8' if fmt == 'f4' else 'c16')
+        o = np.memmap(path + '.DTA', dtype=dtype, mode='r', shape=shape)
+    elif is_complex:
+        raw = np.memmap(path + '.DTA', dtype=byteorder + fmt, mode='r',
+                        shape=shape + (2,))
+        o = raw[..., 0] + 1j * raw[..., 1]
+    else:
+        o = np.memmap(path + '.DTA', dtype=byteorder + fmt, mode='r',
+                      shape=shape)
+
+    return {
+        "o": o,
+        "x": _axis(path, params, 'X'),
+        "y": _axis(path, params, 'Y'),
+        "title": str(params.get('TITL', os.path.basename(path))),
+        "params": params,
+    }
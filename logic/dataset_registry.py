@@ -0,0 +1,110 @@
+# Datasets loaded in the GUI, keyed by the iid of their treeview item
+import numpy as np
+
+
+class DatasetRegistry():
+
+    def __init__(self):
+        # iid -> dataset, in insertion order
+        self._dsets = {}
+        self._folders = {}
+        # Secondary indexes: value -> {iid: None} (ordered set)
+        self._by_title = {}
+        self._by_folder = {}
+        self._by_param = {}
+
+    def __contains__(self, iid):
+        return iid in self._dsets
+
+    def __getitem__(self, iid):
+        return self._dsets[iid]
+
+    def __iter__(self):
+        return iter(self._dsets)
+
+    def __len__(self):
+        return len(self._dsets)
+
+    def add(self, iid, dset, folder=""):
+        """
+        Stores a dataset. An existing dataset with the same iid is replaced.
+        @param iid: iid of the treeview item of the dataset
+        @param dset: Object with x, o and params (dict with at least 'title')
+        @param folder: iid of the treeview item of the folder, "" if none
+        """
+        if iid in self._dsets:
+            self.remove(iid)
+        self._dsets[iid] = dset
+        self._folders[iid] = folder
+        self._by_title.setdefault(dset.params.get('title'), {})[iid] = None
+        self._by_folder.setdefault(folder, {})[iid] = None
+        for key in self._param_keys(dset):
+            self._by_param.setdefault(key, {})[iid] = None
+        return
+
+    def remove(self, iid):
+        # Remove and return the dataset iid
+        dset = self._dsets.pop(iid)
+        folder = self._folders.pop(iid)
+        self._discard(self._by_title, dset.params.get('title'), iid)
+        self._discard(self._by_folder, folder, iid)
+        for key in self._param_keys(dset):
+            self._discard(self._by_param, key, iid)
+        return dset
+
+    def remove_folder(self, folder):
+        # Remove the datasets of a folder, return their iids
+        iids = list(self._by_folder.get(folder, ()))
+        for iid in iids:
+            self.remove(iid)
+        return iids
+
+    def clear(self):
+        self.__init__()
+        return
+
+    def get(self, iid, default=None):
+        return self._dsets.get(iid, default)
+
+    def folder(self, iid):
+        return self._folders[iid]
+
+    def iids(self):
+        return list(self._dsets)
+
+    def by_title(self, title):
+        # iids of the datasets with this title
+        return list(self._by_title.get(title, ()))
+
+    def by_folder(self, folder):
+        # iids of the datasets in the folder, in loading order
+        return list(self._by_folder.get(folder, ()))
+
+    def by_param(self, name, value):
+        # iids of the datasets with params[name] == value, e.g. 'mw_freq'
+        return list(self._by_param.get((name, self._hashable(value)), ()))
+
+    def _param_keys(self, dset):
+        return [(name, self._hashable(value))
+                for name, value in dset.params.items() if name != 'title']
+
+    @staticmethod
+    def _hashable(value):
+        # numpy scalars and arrays as plain python values
+        if isinstance(value, np.ndarray):
+            return tuple(value.tolist())
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, list):
+            return tuple(value)
+        return value
+
+    @staticmethod
+    def _discard(index, value, iid):
+        iids = index.get(value)
+        if iids is None:
+            return
+        iids.pop(iid, None)
+        if not iids:
+            del index[value]
+        return
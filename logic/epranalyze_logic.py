@@ -10,6 +10,8 @@ sys.path.insert(0, "/usr/local/lib/python3.9/dist-packages")
 
 import XeprAPI
 
+from logic.baseline import BaselineCorrector
+
 class XeprPlusLogic():
 
     def __init__(self):
@@ -17,6 +19,8 @@ class XeprPlusLogic():
         self.exps = []
         self.exp_names = []
         self.stop_meas = 0
+        # Polynomial fits reused between calls, see correct_baseline()
+        self.baseline_corrector = BaselineCorrector()
         return
 
     def _check_exp_name(self, exp_name):
@@ -117,7 +121,7 @@ class XeprPlusLogic():
         elif y.ndim == 2:
             # First identify the time slice
             t_argmaxs = np.argmax(np.abs(y), axis=1)
-            t_argmax = np.max(np.bincount(t_argmaxs))
+            t_argmax = np.argmax(np.bincount(t_argmaxs))
             return self.calculate_snr(y[:, t_argmax], noise_idx, mode)
 
 
@@ -126,61 +130,18 @@ class XeprPlusLogic():
             self.xepr.XeprClose()
 
 
-    def correct_baseline(self, data, dim=0, n=0, region=0):
-        if data.ndim > 2:
-            raise ValueError(f"Only 1D or 2D data supported, got ndim={data.ndim}.")
-
-        if dim not in (0, 1):
-            raise ValueError("dim must be 0, 1. Only 1D or 2D data supported.")
-        
-        # One dim fit
-        if isinstance(n, (list, tuple, np.ndarray)):
-            if len(n) != 1:
-                raise ValueError("For 1D fit, polynomial order n must be a scalar")
-            n = n[0]
-
-        if n >= data.shape[dim]:
-            raise ValueError(
-                f"Polynomial order n={n} must be smaller than"
-                "data size {data.shape[dim]}"
-            )
-        
-        orig_ndim = data.ndim
-        if orig_ndim == 1:
-            data = np.reshape(data, [data.size, 1])
-
-        x = np.linspace(-1, 1, data.shape[dim])
-        poly_exponents = np.arange(n + 1)
-        # Vandermonde matrix shape (len(x), n+1)
-        D = x[:, None] ** poly_exponents[None, :]
-
-        if dim == 1:
-            # The dimension along which the data is corrected must be dim 0
-            data = data.T
-
-        if region is not None:
-            if region.size != data.shape[0]:
-                raise ValueError("Region length must match data dimension")
-            p = np.linalg.lstsq(D[region], data[region, :], rcond=None)[0]
-        else:
-            p, _, _, _ = np.linalg.lstsq(D, data, rcond=None)
-        
-        baseline = D.dot(p)
+    def correct_baseline(self, data, dim=0, n=0, region=None):
+        # Polynomial baseline of order n fitted to the boolean mask region
+        # along dim (None: all the points). The least-squares projections
+        # are cached, see BaselineCorrector.
+        return self.baseline_corrector.correct(data, dim, n, region)
+    
 
-        if dim == 1:
-            # Transpose back if necessary
-            baseline = baseline.T
-            data = data.T
+    def correct_baseline_batch(self, datasets, dim=0, n=0, region=None):
+        # Same as correct_baseline for a stack (n_datasets, ...) or a list of
+        # datasets with the same shape, in one vectorized fit
+        return self.baseline_corrector.correct_batch(datasets, dim, n, region)
 
-        if orig_ndim == 1:
-            # Restore initial dimension for 1D array
-            data = np.squeeze(data)
-            baseline = np.squeeze(baseline)
-            
-        datacorr = data - baseline
-        
-        return datacorr, baseline
-    
 
     def create_new_experiment(self, exp_type):
         if exp_type == 0:
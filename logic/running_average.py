@@ -0,0 +1,46 @@
+# Running mean and variance of repeated scans (Welford's algorithm)
+import numpy as np
+
+
+class RunningAverage():
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        # Sum of the squared deviations from the mean
+        self._m2 = None
+
+    def add(self, o):
+        """
+        Adds a scan to the average.
+        @param o: Ordinate of the scan, same shape for all the scans
+        """
+        o = np.asarray(o)
+        if self.n == 0:
+            dtype = np.result_type(o.dtype, np.float64)
+            self.mean = np.zeros(o.shape, dtype=dtype)
+            self._m2 = np.zeros(o.shape, dtype=np.float64)
+        elif o.shape != self.mean.shape:
+            raise ValueError(
+                f"Scan shape {o.shape} does not match {self.mean.shape}.")
+        self.n += 1
+        delta = o - self.mean
+        self.mean += delta / self.n
+        # For complex data the variance is the sum of the variances of the
+        # real and imaginary parts
+        self._m2 += np.real(np.conj(delta) * (o - self.mean))
+        return
+
+    @property
+    def variance(self):
+        # Variance of the single scans at each point
+        if self.n < 2:
+            return None
+        return self._m2 / (self.n - 1)
+
+    @property
+    def std_error(self):
+        # Standard deviation of the mean at each point
+        if self.n < 2:
+            return None
+        return np.sqrt(self.variance / self.n)
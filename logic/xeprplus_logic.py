@@ -1,21 +1,41 @@
 # Locate the XeprAPI module
 from datetime import datetime, timedelta
+import logging
 import numpy as np
 import os
+import queue
 import sys
+import threading
 import time
+import zlib
 
 # sys.path.insert(0, os.popen("Xepr --apipath").read())
 sys.path.insert(0, "/usr/local/lib/python3.9/dist-packages")
 
 import XeprAPI
 
+from logic.baseline import (BaselineCorrector, BaselineMasks, als_baseline,
+                            reweighted_polynomial_baseline)
+from logic.bes3t import SPL_KEYS, write_bes3t, write_bes3t_like
+from logic.running_average import RunningAverage
+
+logger = logging.getLogger(__name__)
+
 class XeprPlusLogic():
 
     def __init__(self):
         self.xepr = None
         self.exp_names = ["CW", "Transient", "Pulse"]
         self.stop_meas = 0
+        # Background saving of the scans, see start_saver()
+        self.save_queue = None
+        self.save_thread = None
+        self.save_template = None
+        # (path, exception) of the scans the saver thread could not write
+        self.save_errors = []
+        # Polynomial fits reused between scans, see correct_baseline()
+        self.baseline_corrector = BaselineCorrector()
+        self.baseline_masks = BaselineMasks()
 
         # Default variables
         self.cw_field_start = 3300.
@@ -78,15 +98,127 @@ class XeprPlusLogic():
         return exp_name
     
 
-    def _command_wait(self, command, parameters='', waiting_time=0.25):
-            if parameters == '':
-                command()
-            else:
-                if not isinstance(parameters, list):
-                    parameters = [parameters]
-                command(*parameters)
-            
-            time.sleep(waiting_time)
+    def _command_wait(self, command, parameters='', waiting_time=0.25,
+                      timeout=60., ready=None):
+        # Run an Xepr command and return as soon as Xepr is ready again.
+        # ready: function returning True when the command is finished, by
+        # default when the current experiment is not running anymore. It is
+        # polled with an interval growing from 5 ms to 250 ms, for at most
+        # timeout s after the command returned.
+        # waiting_time: minimum time in s to wait after the command. Pass 0
+        # only with a ready() that proves the result of the command, e.g.
+        # _new_dataset_ready.
+        # Return False if ready() was not True within timeout.
+        name = getattr(command, '__name__', str(command))
+        start_time = time.time()
+        if parameters == '':
+            command()
+        else:
+            if not isinstance(parameters, list):
+                parameters = [parameters]
+            command(*parameters)
+
+        if ready is None:
+            ready = self._xepr_ready
+        is_ready = True
+        ready_start = time.time()
+        interval = 0.005
+        while not ready():
+            if time.time() - ready_start > timeout:
+                logger.warning(
+                    f"{name}: not ready after {timeout} s.")
+                is_ready = False
+                break
+            time.sleep(interval)
+            interval = min(2 * interval, 0.25)
+
+        remaining = waiting_time - (time.time() - start_time)
+        if remaining > 0:
+            time.sleep(remaining)
+        logger.debug(f"{name}: {(time.time() - start_time) * 1e3:.1f} ms")
+        return is_ready
+
+
+    def _xepr_ready(self):
+        # True if the current experiment is not running
+        try:
+            return not self.xepr.XeprExperiment().isRunning
+        except Exception:
+            # No current experiment
+            return True
+
+
+    def _dataset_signature(self, xeprset='primary'):
+        # Checksum of the ordinate of the dataset, None if there is none
+        try:
+            o = np.ascontiguousarray(self.get_dataset(xeprset=xeprset).O)
+        except Exception:
+            return None
+        if o.size == 0:
+            return None
+        return zlib.crc32(o.tobytes())
+
+
+    def _new_dataset_ready(self):
+        # ready() for aqExpRunAndWait, to be created before the run. True
+        # when the experiment is not running and the primary dataset differs
+        # from the one before the run (the previous scan) and did not change
+        # since the last poll.
+        previous = self._dataset_signature()
+        last = [previous]
+
+        def ready():
+            if not self._xepr_ready():
+                return False
+            signature = self._dataset_signature()
+            is_new = (signature is not None and signature != previous and
+                      signature == last[0])
+            last[0] = signature
+            return is_new
+        return ready
+
+
+    def _run_scan(self, exp):
+        # aqExpRunAndWait, waiting until the new dataset is available.
+        # Return False if the dataset did not change, e.g. the scan was
+        # aborted: it must not be saved or averaged again.
+        ready = self._new_dataset_ready()
+        return self._command_wait(exp.aqExpRunAndWait, waiting_time=0,
+                                  timeout=10., ready=ready)
+
+
+    def _par_ready(self, exp_name, par_name, value):
+        # ready() for aqParSet: True when the parameter reads back value.
+        # None if the parameter cannot be read back. Xepr reads back the
+        # set value immediately, so this only shows that the value was
+        # accepted, not that the device reached it.
+        try:
+            par = self.xepr.XeprExperiment(exp_name)[par_name.split('.')[-1]]
+            par.value
+        except Exception:
+            return None
+
+        def ready():
+            current = par.value
+            if isinstance(value, (int, float)):
+                # Xepr may round to the resolution of the device
+                return np.isclose(float(current), value, rtol=1e-3,
+                                  atol=1e-9)
+            return str(current) == str(value)
+        return ready
+
+
+    def _set_par(self, exp_name, par_name, value):
+        # aqParSet with the fixed waiting time for the device, warning if
+        # the new value is not read back
+        ready = self._par_ready(exp_name, par_name, value)
+        if ready is None:
+            self._command_wait(self.xepr.XeprCmds.aqParSet,
+                               [exp_name, par_name, value])
+        else:
+            self._command_wait(self.xepr.XeprCmds.aqParSet,
+                               [exp_name, par_name, value], timeout=2.,
+                               ready=ready)
     
     
     def adjust_lock_offset(self):
@@ -123,12 +255,11 @@ class XeprPlusLogic():
         return 0
     
 
-    def baseline_region(self, x, bl_type="width", region=0.15):
-        if bl_type == "width":
-            left = np.min(x) + (np.max(x) - np.min(x)) * region
-            right = np.max(x) - (np.max(x) - np.min(x)) * region
-            return (x <= left) | (x >= right)
-        elif bl_type == "range":
+    def baseline_region(self, x, bl_type="width", region=0.15, kind="mask"):
+        # Baseline points of x, memoized per axis and region (see
+        # BaselineMasks). kind="mask" returns a read-only boolean mask,
+        # kind="slices" a list of slices.
+        if bl_type == "range":
             if not isinstance(region, list):
                 raise Exception(
                     "For bl_type equal 'range' region must be a list.")
@@ -144,30 +275,69 @@ class XeprPlusLogic():
                         raise Exception(
                             "For bl_type equal 'range' region " +
                             "be a list of len 2 or a list of lists of len 2.")
-            
-            bl = [False for _ in range(len(x))]
-            for reg in region:
-                new_bl = (x >= reg[0]) & (x <= reg[1])
-                bl = bl | new_bl
-            return bl
+        elif bl_type != "width":
+            raise Exception("bl_type must be 'width' or 'range'")
+        if kind not in ("mask", "slices"):
+            raise Exception("kind must be 'mask' or 'slices'")
+        return self.baseline_masks.get(x, bl_type, region, kind)
 
     def calculate_snr(self, y, noise_idx, mode="std"):
+        # SNR of a 1D trace. For 2D data (field, time) the SNR of the time
+        # slice where most field points have their maximum.
         if y.ndim == 1:
-            sig_lev = np.max(y) - np.min(y)
-            if mode == "std":
-                noise_lev = np.std(y[noise_idx])
-            elif mode == "pkpk":
-                noise_lev = np.max(y[noise_idx]) - np.min(y[noise_idx])
-            else:
-                raise Exception("mode must be 'std' or 'pkpk'")
-            snr = sig_lev / noise_lev
-
-            return snr, sig_lev, noise_lev
+            snr, sig_lev, noise_lev, _ = self.calculate_snr_profile(
+                y[:, None], noise_idx, mode)
+            return snr[0], sig_lev[0], noise_lev[0]
         elif y.ndim == 2:
             # First identify the time slice
             t_argmaxs = np.argmax(np.abs(y), axis=1)
-            t_argmax = np.max(np.bincount(t_argmaxs))
-            return self.calculate_snr(y[:, t_argmax], noise_idx, mode)
+            t_argmax = np.argmax(np.bincount(t_argmaxs))
+            snr, sig_lev, noise_lev, _ = self.calculate_snr_profile(
+                y[:, t_argmax:t_argmax + 1], noise_idx, mode)
+            return snr[0], sig_lev[0], noise_lev[0]
+
+
+    def calculate_snr_profile(self, y, noise_idx, mode="std", window=1):
+        """
+        SNR of all the time slices of 2D data at once.
+        @param y: 2D array (field, time)
+        @param noise_idx: Boolean mask or indices of the noise points along
+            field
+        @param mode: Noise level as "std", "pkpk" (peak to peak) or "mad"
+            (median absolute deviation, scaled to the std of normal noise)
+        @param window: Number of adjacent time slices averaged before the
+            calculation (moving average centered on each slice)
+        @return: snr, sig_lev and noise_lev, one value per time slice, and
+            the index of the slice with the largest SNR (-1 if the SNR of
+            all the slices is nan, e.g. flat data)
+        """
+        if mode not in ("std", "pkpk", "mad"):
+            raise Exception("mode must be 'std', 'pkpk' or 'mad'")
+        # At most all the time slices
+        window = min(int(window), y.shape[1])
+        if window > 1:
+            # Moving average along time centered on each slice, same length
+            # as y. At the edges only the slices inside y are averaged.
+            csum = np.cumsum(np.pad(y, ((0, 0), (1, 0))), axis=1)
+            t = np.arange(y.shape[1])
+            lo = np.maximum(t - (window - 1) // 2, 0)
+            hi = np.minimum(t + window // 2 + 1, y.shape[1])
+            y = (csum[:, hi] - csum[:, lo]) / (hi - lo)
+
+        sig_lev = np.max(y, axis=0) - np.min(y, axis=0)
+        noise = y[noise_idx, :]
+        if mode == "std":
+            noise_lev = np.std(noise, axis=0)
+        elif mode == "pkpk":
+            noise_lev = np.max(noise, axis=0) - np.min(noise, axis=0)
+        else:
+            noise_lev = 1.4826 * np.median(
+                np.abs(noise - np.median(noise, axis=0)), axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            snr = sig_lev / noise_lev
+        if np.all(np.isnan(snr)):
+            return snr, sig_lev, noise_lev, -1
+        return snr, sig_lev, noise_lev, int(np.nanargmax(snr))
 
 
     def close_xepr_api(self):
@@ -175,61 +345,63 @@ class XeprPlusLogic():
             self.xepr.XeprClose()
 
 
-    def correct_baseline(self, data, dim=0, n=0, region=0):
-        if data.ndim > 2:
-            raise ValueError(f"Only 1D or 2D data supported, got ndim={data.ndim}.")
+    def correct_baseline(self, data, dim=0, n=0, region=None):
+        # Polynomial baseline of order n fitted to the boolean mask region
+        # along dim (None: all the points). The least-squares projections
+        # are cached, see BaselineCorrector.
+        return self.baseline_corrector.correct(data, dim, n, region)
+    
 
-        if dim not in (0, 1):
-            raise ValueError("dim must be 0, 1. Only 1D or 2D data supported.")
-        
-        # One dim fit
-        if isinstance(n, (list, tuple, np.ndarray)):
-            if len(n) != 1:
-                raise ValueError("For 1D fit, polynomial order n must be a scalar")
-            n = n[0]
-
-        if n >= data.shape[dim]:
-            raise ValueError(
-                f"Polynomial order n={n} must be smaller than"
-                "data size {data.shape[dim]}"
-            )
-        
-        orig_ndim = data.ndim
-        if orig_ndim == 1:
-            data = np.reshape(data, [data.size, 1])
-
-        x = np.linspace(-1, 1, data.shape[dim])
-        poly_exponents = np.arange(n + 1)
-        # Vandermonde matrix shape (len(x), n+1)
-        D = x[:, None] ** poly_exponents[None, :]
-
-        if dim == 1:
-            # The dimension along which the data is corrected must be dim 0
-            data = data.T
-
-        if region is not None:
-            if region.size != data.shape[0]:
-                raise ValueError("Region length must match data dimension")
-            p = np.linalg.lstsq(D[region], data[region, :], rcond=None)[0]
+    def correct_baseline_batch(self, datasets, dim=0, n=0, region=None):
+        # Same as correct_baseline for a stack (n_datasets, ...) or a list of
+        # datasets with the same shape, in one vectorized fit
+        return self.baseline_corrector.correct_batch(datasets, dim, n, region)
+
+
+    def correct_baseline_robust(self, data, dim=0, method="als", **kwargs):
+        """
+        Baseline correction without a baseline region.
+        @param method: "als" (asymmetric least squares, for lines of one
+            sign) or "poly" (iteratively reweighted polynomial, also for
+            derivative lines)
+        @param kwargs: Passed to als_baseline or
+            reweighted_polynomial_baseline, e.g. lam and p, or n
+        @return: Corrected data and baseline, same shape as data
+        """
+        if method == "als":
+            baseline = als_baseline(data, dim, **kwargs)
+        elif method == "poly":
+            baseline = reweighted_polynomial_baseline(data, dim, **kwargs)
         else:
-            p, _, _, _ = np.linalg.lstsq(D, data, rcond=None)
-        
-        baseline = D.dot(p)
+            raise ValueError("method must be 'als' or 'poly'")
+        return data - baseline, baseline
 
-        if dim == 1:
-            # Transpose back if necessary
-            baseline = baseline.T
-            data = data.T
 
-        if orig_ndim == 1:
-            # Restore initial dimension for 1D array
-            data = np.squeeze(data)
-            baseline = np.squeeze(baseline)
+    def corrected_snr(self, o, x, y=None):
+        # SNR after baseline correction. Abscissa 1 (x) is field for 1D data,
+        # time for 2D data.
+        if o.ndim == 1:
+            # Correct along field
+            bl_region_bfield = self.baseline_region(x, "width", 0.15)
             
-        datacorr = data - baseline
-        
-        return datacorr, baseline
-    
+            ord_fin, bl_fin = self.correct_baseline(
+                o, region=bl_region_bfield)
+        else:
+            # Here x is time and y is field
+            # Correct along time
+            # Assuming flash after 30 ns
+            bl_region_t = self.baseline_region(x, "range", [0, 30])
+            ord_mid, bl_mid = self.correct_baseline(
+                o, dim=1, region=bl_region_t)
+
+            # Correct along field
+            bl_region_bfield = self.baseline_region(y, "width", 0.15)
+            ord_fin, bl_fin = self.correct_baseline(
+                ord_mid, dim=0, region=bl_region_bfield)
+            
+        snr, _, _ = self.calculate_snr(ord_fin, bl_region_bfield)
+        return snr
+
 
     def create_new_experiment(self, exp_name):
         if exp_name == self.exp_names[0]:
@@ -330,7 +502,7 @@ class XeprPlusLogic():
     def load_data(self, path, viewport):
         # Viewport should be 'primary' or 'secondary'
         args = [path, 'None', viewport]
-        self._command_wait(self.xepr.XeprCmds.vpLoad, *args)
+        self._command_wait(self.xepr.XeprCmds.vpLoad, args)
 
 
     def open_xepr_api(self):
@@ -351,76 +523,81 @@ class XeprPlusLogic():
 
     def run_meas(self, folder, meas_name):
         exp = self.xepr.XeprExperiment()
-        self._command_wait(exp.aqExpRunAndWait, waiting_time=5)
+        if not self._run_scan(exp):
+            logger.warning("No new dataset, not saved.")
+            return -1
         self.save_meas(folder, meas_name)
         return 0
     
     
-    def run_meas_goal_snr(self, folder, exp_name, goal_snr):
+    def run_meas_goal_snr(self, folder, exp_name, goal_snr, max_scans=None):
+        """
+        Runs scans until the baseline-corrected SNR of their average reaches
+        goal_snr. The SNR is recalculated after each scan.
+        @param max_scans: Maximum number of scans. If None, four times the
+            number estimated from the first scan.
+        """
         # Create save folder and variables
         save_folder = os.path.join(folder, exp_name)
         os.mkdir(save_folder)
         
         # Get current experiment
         exp = self.xepr.XeprExperiment()
-        
-        # Run first scan
-        status = self.adjust_lock_offset()
-        self._command_wait(exp.aqExpRunAndWait, waiting_time=5)
-        meas_name = exp_name + f"-{1:05d}"
-        self.save_meas(save_folder, meas_name)
-        
-        # SNR per scan
-        # Calculate SNR after baseline correction
-        dset = self.get_dataset(xeprset="primary")
-        ord0 = np.array(dset.O)
-        # Abscissa 1 is field for 1D data, time for 2D data
-        x = np.array(dset.X)  # Abscissa 1
-        
-        if ord0.ndim == 1:
-            # Correct along field
-            bl_region_bfield = self.baseline_region(x, "width", 0.15)
-            
-            ord_fin, bl_fin = self.correct_baseline(
-                ord0, region=bl_region_bfield)
-        else:
-            # Here x is time and y is field
-            y = np.array(dset.Y)  # Abscissa 2
-            # Correct along time
-            # Assuming flash after 30 ns
-            bl_region_t = self.baseline_region(x, "range", [0, 30])
-            ord_mid, bl_mid = self.correct_baseline(
-                ord0, dim=1, region=bl_region_t)
-
-            # Correct along field
-            bl_region_bfield = self.baseline_region(y, "width", 0.15)
-            ord_fin, bl_fin = self.correct_baseline(
-                ord_mid, dim=0, region=bl_region_bfield)
-            
-        # SNR of first scan
-        snr, _, _ = self.calculate_snr(ord_fin, bl_region_bfield)
-        
-        n_scan = int(np.ceil((goal_snr/snr)**2))
-        if n_scan < 2:
-            return
-        
-        for i_meas in range(2, n_scan + 1):
-            # Check if stop measurement was requested
-            if self.stop_meas == 1:
-                self.stop_meas = 0
-                break
+        self.start_saver()
+        try:
+            # Average of the scans, kept in memory
+            average = RunningAverage()
+            i_meas = 0
+            while True:
+                # Check if stop measurement was requested
+                if self.stop_meas == 1:
+                    self.stop_meas = 0
+                    break
             
-            # Adjust lock offset
-            status = self.adjust_lock_offset()
-            # if status == -1:
-                # logging.info('Exceeded max time for adjustLockOffset')
+                # Adjust lock offset
+                status = self.adjust_lock_offset()
+                # if status == -1:
+                    # logging.info('Exceeded max time for adjustLockOffset')
                 
-            # Run scan
-            self._command_wait(exp.aqExpRunAndWait, waiting_time=5)
+                # Run scan
+                if not self._run_scan(exp):
+                    logger.warning(f"Scan {i_meas + 1}: no new dataset, "
+                                   "scan repeated.")
+                    continue
+                i_meas += 1
+                meas_name = exp_name + f"-{i_meas:05d}"
+                snapshot = self.save_meas_background(save_folder, meas_name)
             
-            meas_name = exp_name + f"-{i_meas:05d}"
-            self.save_meas(save_folder, meas_name)
-        
+                # SNR of the average after baseline correction
+                average.add(snapshot["o"])
+                snr = self.corrected_snr(average.mean, snapshot["x"],
+                                         snapshot["y"])
+                if snr >= goal_snr:
+                    logger.info(f"Goal SNR {goal_snr} reached after {i_meas} "
+                                f"scans (SNR {snr:.1f}).")
+                    break
+                if not np.isfinite(snr) or snr <= 0:
+                    # Flat or failed scans: no estimate, only max_scans
+                    # or a stop request end the run
+                    logger.warning(f"Scan {i_meas}: SNR not available.")
+                    if max_scans is not None and i_meas >= max_scans:
+                        break
+                    continue
+
+                if max_scans is None:
+                    max_scans = 4 * int(np.ceil((goal_snr/snr)**2))
+                if i_meas >= max_scans:
+                    logger.info(f"Goal SNR {goal_snr} not reached after "
+                                f"{i_meas} scans (SNR {snr:.1f}).")
+                    break
+                # Extrapolate from the SNR of the average, which grows as the
+                # square root of the number of scans
+                n_scan = int(np.ceil(i_meas * (goal_snr/snr)**2))
+                logger.info(f"Scan {i_meas}: SNR {snr:.1f}, about "
+                            f"{min(n_scan, max_scans) - i_meas} scans to go.")
+        finally:
+            # Write the last scans, also if the loop failed
+            self.stop_saver()
         return 0
 
 
@@ -434,25 +611,33 @@ class XeprPlusLogic():
         time_now = datetime.now()
         time_end = time_now + timedelta(hours=hours, minutes=minutes)
         exp = self.xepr.XeprExperiment()
-        while time_now < time_end:
-            # Check if stop measurement was requested
-            if self.stop_meas == 1:
-                self.stop_meas = 0
-                break
-
-            # Adjust lock offset
-            status = self.adjust_lock_offset()
-            # if status == -1:
-                # logging.info('Exceeded max time for adjustLockOffset')
+        self.start_saver()
+        try:
+            while time_now < time_end:
+                # Check if stop measurement was requested
+                if self.stop_meas == 1:
+                    self.stop_meas = 0
+                    break
+
+                # Adjust lock offset
+                status = self.adjust_lock_offset()
+                # if status == -1:
+                    # logging.info('Exceeded max time for adjustLockOffset')
                 
-            i_meas += 1
-            self._command_wait(exp.aqExpRunAndWait, waiting_time=5)
-            
-            meas_name = exp_name + f"-{i_meas:05d}"
-            self.save_meas(save_folder, meas_name)
+                if not self._run_scan(exp):
+                    logger.warning(f"Scan {i_meas + 1}: no new dataset, "
+                                   "scan repeated.")
+                    time_now = datetime.now()
+                    continue
+                i_meas += 1
             
-            time_now = datetime.now()
+                meas_name = exp_name + f"-{i_meas:05d}"
+                self.save_meas_background(save_folder, meas_name)
             
+                time_now = datetime.now()
+        finally:
+            # Write the last scans, also if the loop failed
+            self.stop_saver()
         return 0
 
 
@@ -465,10 +650,116 @@ class XeprPlusLogic():
         # Exp to primary window
         self.xepr.XeprCmds.aqExpSelect(1, exp.aqGetExpName())
 
+
+
+    def save_meas_background(self, folder, meas_name):
+        # Copy the current dataset to memory and queue it for writing by the
+        # saver thread, so that the next scan can start immediately. Return
+        # the copy (dict with o, x, y, title, params, time).
+        # The first scan after start_saver() is saved by Xepr (vpSave) and
+        # its descriptor, with all the parameter layers, is the template of
+        # the following ones.
+        # Raise after queuing the scan if the saver thread could not write
+        # earlier scans, so that the measurement stops.
+        exp = self.xepr.XeprExperiment()
+        # Exp to primary window
+        self.xepr.XeprCmds.aqExpSelect(1, exp.aqGetExpName())
+        snapshot = self.snapshot_dataset(xeprset="primary")
+        path = os.path.join(folder, meas_name)
+        if self.save_template is None:
+            self.save_meas(folder, meas_name)
+            self.save_template = path
+            return snapshot
+        # Blocks only if the writer is more than maxsize scans behind
+        self.save_queue.put((path, self.save_template, snapshot))
+        self._raise_save_errors()
+        return snapshot
+
+
+    def snapshot_dataset(self, xeprset='primary'):
+        dset = self.get_dataset(xeprset=xeprset)
+        o = np.array(dset.O)
+        params = {}
+        for key in SPL_KEYS:
+            try:
+                params[key] = dset.getSPLReal(key)
+            except Exception:
+                # Parameter not defined for this experiment
+                continue
+        return {
+            "o": o,
+            "x": np.array(dset.X),
+            "y": np.array(dset.Y) if o.ndim == 2 else None,
+            "title": dset.getTitle(),
+            "params": params,
+            # Time of the acquisition, not of the writing
+            "time": datetime.now(),
+        }
+
+
+    def start_saver(self, maxsize=16):
+        # Start the thread writing the datasets queued by
+        # save_meas_background
+        self.save_queue = queue.Queue(maxsize=maxsize)
+        self.save_template = None
+        self.save_errors = []
+        self.save_thread = threading.Thread(
+            target=self._saver_loop, args=(self.save_queue,), daemon=True)
+        self.save_thread.start()
+
+
+    def stop_saver(self):
+        # Write the datasets still in the queue and stop the thread. Raise
+        # if scans could not be written.
+        if self.save_thread is None:
+            return
+        self.save_queue.put(None)
+        self.save_thread.join()
+        self.save_queue = None
+        self.save_thread = None
+        self._raise_save_errors()
+
+
+    def _raise_save_errors(self):
+        # Raise the errors of the saver thread not reported yet
+        errors, self.save_errors = self.save_errors, []
+        if not errors:
+            return
+        paths = ", ".join(path for path, _ in errors)
+        raise Exception(
+            f"{len(errors)} scans could not be saved: {paths}") \
+            from errors[0][1]
+
+
+    def _saver_loop(self, save_queue):
+        while True:
+            item = save_queue.get()
+            if item is None:
+                return
+            path, template, snapshot = item
+            try:
+                try:
+                    write_bes3t_like(path, template, snapshot["o"],
+                                     snapshot["title"], snapshot["params"],
+                                     snapshot["time"])
+                except ValueError:
+                    # Data shape changed since the template: minimal
+                    # descriptor
+                    logger.warning(f"{path} saved without the parameter "
+                                   "layers of the template")
+                    write_bes3t(path, snapshot["o"], snapshot["x"],
+                                snapshot["y"], snapshot["title"],
+                                snapshot["params"])
+            except Exception as e:
+                logger.exception(f"Could not save {path}")
+                # Reported by save_meas_background or stop_saver
+                self.save_errors.append((path, e))
+
         
     def send_to_spectrometer(self, exp_name):
+        # No completion check available: the previous fixed delay
         self._command_wait(
-            self.xepr.XeprExperiment(exp_name).aqExpActivate(),
+            self.xepr.XeprExperiment(exp_name).aqExpActivate,
             waiting_time=2)
     
     
@@ -536,8 +827,7 @@ class XeprPlusLogic():
                     continue
             
             # Set new parameter on the hardware
-            args = [self.exp_names[0], param_map[param_name], value]
-            self._command_wait(self.xepr.XeprCmds.aqParSet, *args)
+            self._set_par(self.exp_names[0], param_map[param_name], value)
 
         # Get all parameters from the hardware
         exp = self.xepr.XeprExperiment(exp_name)
@@ -605,7 +895,6 @@ class XeprPlusLogic():
 
 
     def set_temperature(self, temperature):
-        args = ['AcqHidden', '*gTempCtrl.Temperature', temperature]
-        self._command_wait(self.xepr.XeprCmds.aqParSet, *args)
+        self._set_par('AcqHidden', '*gTempCtrl.Temperature', temperature)
 
 
@@ -134,7 +134,7 @@ class XeprPlusLogic():
         elif y.ndim == 2:
             # First identify the time slice
             t_argmaxs = np.argmax(np.abs(y), axis=1)
-            t_argmax = np.max(np.bincount(t_argmaxs))
+            t_argmax = np.argmax(np.bincount(t_argmaxs))
             return self.calculate_snr(y[:, t_argmax], noise_idx, mode)
 
 